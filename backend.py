@@ -0,0 +1,122 @@
+import os
+import asyncio
+import aiohttp
+
+from yarl import URL
+from cache import TTLCache
+from time import perf_counter
+from logger import log, LogMode
+from models import loads
+from metrics import metrics, operation_name
+
+
+BACKEND_URL = os.environ.get("cinotes_backend_url", "https://back.cintoes.link")
+BACKEND_CONNECTIONS_LIMIT = int(os.environ.get("cinotes_backend_connections_limit", 100))
+BACKEND_CONNECTIONS_PER_HOST = int(os.environ.get("cinotes_backend_connections_per_host", 20))
+BACKEND_TIMEOUT = float(os.environ.get("cinotes_backend_timeout", 10))
+BACKEND_RETRIES = int(os.environ.get("cinotes_backend_retries", 2))
+BACKEND_RETRY_BACKOFF = float(os.environ.get("cinotes_backend_retry_backoff", 0.3))
+CATALOG_CACHE_SIZE = int(os.environ.get("cinotes_catalog_cache_size", 2048))
+CATALOG_CACHE_TTL = float(os.environ.get("cinotes_catalog_cache_ttl", 600))
+
+RETRY_STATUSES = {502, 503, 504}
+
+
+class BackendResponse:
+    __slots__ = ("status_code", "text")
+
+    def __init__(self, status_code: int, text: str):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return loads(self.text)
+
+
+class BackendClient:
+    def __init__(self, base_url: str = BACKEND_URL):
+        self.base_url = URL(base_url)
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=BACKEND_CONNECTIONS_LIMIT, limit_per_host=BACKEND_CONNECTIONS_PER_HOST, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=BACKEND_TIMEOUT))
+        return self._session
+
+    async def request(self, method: str, path: str, *, params: dict = None, json_data: dict = None, headers: dict = None) -> BackendResponse:
+        started = perf_counter()
+        try:
+            result = await self._request(method, path, params=params, json_data=json_data, headers=headers)
+        except Exception:
+            metrics.observe(operation_name(f"backend {method}", path), perf_counter() - started, error=True)
+            raise
+
+        metrics.observe(operation_name(f"backend {method}", path), perf_counter() - started, error=result.status_code >= 500)
+        return result
+
+    async def _request(self, method: str, path: str, *, params: dict = None, json_data: dict = None, headers: dict = None) -> BackendResponse:
+        url = self.base_url.with_path(path)
+        if params:
+            url = url.with_query({k: str(v) for k, v in params.items()})
+
+        # only idempotent requests are retried after the server has seen them
+        idempotent = method == "GET"
+
+        for attempt in range(BACKEND_RETRIES + 1):
+            last_attempt = attempt == BACKEND_RETRIES
+            try:
+                async with self._get_session().request(method, url, json=json_data, headers=headers) as response:
+                    result = BackendResponse(response.status, await response.text())
+
+                if result.status_code not in RETRY_STATUSES or not idempotent or last_attempt:
+                    return result
+                log(f"Backend returned {result.status_code} on {method} {url}, retrying", LogMode.WARNING)
+            except aiohttp.ClientConnectorError as e:
+                # the connection was never made, so the server has not seen the request
+                if last_attempt:
+                    raise
+                log(f"Backend connection error on {method} {url}: type: '{type(e).__name__}', text: '{e}', retrying", LogMode.WARNING)
+            except (aiohttp.ServerDisconnectedError, asyncio.TimeoutError) as e:
+                # the server may already have received the body
+                if not idempotent or last_attempt:
+                    raise
+                log(f"Backend {type(e).__name__} on {method} {url}, retrying", LogMode.WARNING)
+
+            await asyncio.sleep(BACKEND_RETRY_BACKOFF * 2 ** attempt)
+
+    async def get(self, path: str, jwt: str = None, **params) -> BackendResponse:
+        headers = {"Authorization": "Bearer " + jwt} if jwt else None
+        return await self.request("GET", path, params=params, headers=headers)
+
+    async def post(self, path: str, data: dict) -> BackendResponse:
+        return await self.request("POST", path, json_data=data)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+backend = BackendClient()
+catalog_cache = TTLCache(CATALOG_CACHE_SIZE, CATALOG_CACHE_TTL)
+
+
+async def get_json(path: str, jwt: str = None, **params):
+    response = await backend.get(path, jwt, **params)
+    if response.status_code != 200:
+        raise LookupError(f"{path}: status code {response.status_code}")
+
+    data = response.json()
+    if data == {"detail": "Not found."}:
+        raise LookupError(f"{path}: not found")
+    return data
+
+
+async def get_catalog(model, path: str, jwt: str = None, **params):
+    async def fetch():
+        # only the parsed model is cached, the raw response is dropped right away
+        return model.from_json(await get_json(path, jwt, **params))
+
+    # catalog data is the same for every user, so the token is not part of the key
+    key = (path, tuple(sorted((k, str(v)) for k, v in params.items())))
+    return await catalog_cache.get_or_fetch(key, fetch)
@@ -0,0 +1,390 @@
+import os
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+
+from aiohttp import web
+
+
+BENCH_TOKEN = "123456:benchmark"
+BENCH_OWNER_ID = 1
+BENCH_USER_ID = 1000
+BENCH_GENRES = ("Drama", "Comedy", "Thriller", "Horror")
+BENCH_FILMS = 400
+
+SCENARIOS = ("start", "getrec", "moreinfo", "stat")
+
+
+def fake_jwt(user_id: int, user_type: str, exp: int) -> str:
+    def part(data: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+    return f"{part({'alg': 'HS256'})}.{part({'id': user_id, 'userType': user_type, 'exp': exp})}.signature"
+
+
+def film_json(film_id: int) -> dict:
+    return {
+        "url": f"https://back.cintoes.link/films/{film_id}/",
+        "title": f"Film {film_id}",
+        "poster_file": f"https://back.cintoes.link/media/posters/{film_id}.jpg",
+        "country": "Ukraine",
+        "release_date": "2022-01-01",
+        "rating": 4.5,
+        "imdb_rating": 7.1,
+        "genres": [{"title": BENCH_GENRES[film_id % len(BENCH_GENRES)]}],
+        "studio": "Studio",
+        "director": "Director"
+    }
+
+
+class FakeTelegram:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self.owner_messages = 0
+        self._message_id = 0
+
+    def _message(self, chat_id, data: dict) -> dict:
+        self._message_id += 1
+        message = {"message_id": self._message_id, "date": int(time.time()), "chat": {"id": int(chat_id), "type": "private"}}
+        if "caption" in data:
+            message["caption"] = data["caption"]
+        if "text" in data:
+            message["text"] = data["text"]
+        return message
+
+    async def handle(self, request: web.Request):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+        method = request.match_info["method"]
+        data = dict(await request.post())
+
+        if method in ("answerCallbackQuery", "deleteMessage", "setWebhook", "deleteWebhook"):
+            return web.json_response({"ok": True, "result": True})
+
+        chat_id = data.get("chat_id", 0)
+        if str(chat_id) == str(BENCH_OWNER_ID):
+            self.owner_messages += 1
+
+        message = self._message(chat_id, data)
+        if method == "sendPhoto":
+            file_id = f"photo-{abs(hash(str(data.get('photo'))))}"
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 100, "height": 150}]
+
+        return web.json_response({"ok": True, "result": message})
+
+
+class FakeBackend:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+
+    async def _reply(self, data):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return web.json_response(data)
+
+    async def user_data(self, request: web.Request):
+        user_id = int(request.query["user_id"])
+        return await self._reply({"id": user_id, "FavActor": 1, "FavGenre": user_id % len(BENCH_GENRES), "FavFilm": 1})
+
+    async def actor(self, request: web.Request):
+        return await self._reply({"id": int(request.match_info["id"]), "name": "Actor"})
+
+    async def genre(self, request: web.Request):
+        return await self._reply({"id": int(request.match_info["id"]), "title": BENCH_GENRES[int(request.match_info["id"]) % len(BENCH_GENRES)]})
+
+    async def film(self, request: web.Request):
+        return await self._reply(film_json(int(request.match_info["id"])))
+
+    async def films(self, request: web.Request):
+        genre = BENCH_GENRES.index(request.query["genre"])
+        page_size = int(request.query.get("page_size", 10))
+        results = [film_json(film_id) for film_id in range(genre, BENCH_FILMS, len(BENCH_GENRES))][:page_size]
+        return await self._reply({"count": len(results), "results": results})
+
+
+# answers the statements the bot issues with the same result contract as cur_executor
+class MemoryDatabase:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self.users = dict()
+        self.accounts = dict()
+        self.usage = dict()
+        self.posters = dict()
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def execute(self, command: str, *args):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return self._execute(" ".join(command.split()), args)
+
+    async def execute_values(self, command: str, rows: list, template: str = None):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+        written = []
+        for recommendation_id, user_id, on_date, film_id in rows:
+            if recommendation_id not in self.usage:
+                self.usage[recommendation_id] = (user_id, on_date, int(film_id))
+                written.append((recommendation_id,))
+        return written
+
+    def _execute(self, command: str, args: tuple):
+        from stats import STATS_QUERY
+        from sessions import SESSION_QUERY, WARM_SESSIONS_QUERY
+
+        if command == " ".join(SESSION_QUERY.split()):
+            user_id = args[0]
+            return [(self.users.get(user_id), *self.accounts.get(user_id, (None, None, None)))]
+        if command == " ".join(WARM_SESSIONS_QUERY.split()):
+            active = list(dict.fromkeys(user_id for user_id, _, _ in self.usage.values()))[:args[1]]
+            return [(user_id, self.users[user_id], *self.accounts.get(user_id, (None, None, None))) for user_id in active if user_id in self.users]
+        if command == " ".join(STATS_QUERY.split()):
+            today = args[0]
+            by_day, by_user = dict(), dict()
+            for user_id, on_date, _ in self.usage.values():
+                by_day[on_date] = by_day.get(on_date, 0) + 1
+                by_user[user_id] = by_user.get(user_id, 0) + 1
+            types = [account[0] for account in self.accounts.values()]
+            return [(
+                len(self.users), len(self.accounts), types.count("admin"), types.count("premium"),
+                len(self.usage), by_day.get(today, 0),
+                sorted(([str(day), count] for day, count in by_day.items()), reverse=True)[:args[2]],
+                sorted(([user_id, count] for user_id, count in by_user.items()), key=lambda x: -x[1])[:args[3]]
+            )]
+        if command.startswith("SELECT user_id FROM accounts WHERE user_type='admin'"):
+            return [(user_id,) for user_id, account in self.accounts.items() if account[0] == "admin"]
+        if command.startswith("SELECT DISTINCT film_id FROM recommendation_system_usage"):
+            return [(film_id,) for film_id in {film_id for user_id, _, film_id in self.usage.values() if user_id == args[0]}]
+        if command.startswith("SELECT user_id, film_id FROM recommendation_system_usage WHERE user_id = ANY"):
+            return [(user_id, film_id) for user_id, _, film_id in self.usage.values() if user_id in args[0]]
+        if command.startswith("SELECT film_id, file_id FROM poster_file_ids"):
+            return list(self.posters.items())
+        if command.startswith("INSERT INTO poster_file_ids"):
+            self.posters[args[0]] = args[1]
+            return [(args[0],)]
+        if command.startswith("INSERT INTO users"):
+            inserted = args[0] not in self.users
+            self.users[args[0]] = args[1]
+            return [(inserted,)]
+        if command.startswith("INSERT INTO accounts"):
+            self.accounts[args[0]] = args[1:]
+            return [(args[0],)]
+        if command.startswith("DELETE FROM accounts"):
+            return [(args[0],)] if self.accounts.pop(args[0], None) else []
+        if command.startswith("SELECT COUNT(*) FROM users"):
+            return [(len(self.users),)]
+        if command.startswith(("CREATE", "SELECT pg_notify")):
+            return ["ProgrammingError", "no results to fetch"]
+
+        return ["NotImplementedError", f"benchmark database does not know: {command[:80]}"]
+
+
+def make_message_update(update_id: int, chat_id: int, text: str) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+        "text": text
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def make_callback_update(update_id: int, chat_id: int, film_id: int) -> dict:
+    title = f"Film {film_id}"
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": "benchmark",
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+            "data": f"moreinfo_{film_id}",
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "caption": title,
+                "caption_entities": [{"type": "text_link", "offset": 0, "length": len(title), "url": f"https://cintoes.link/films/{film_id}"}]
+            }
+        }
+    }
+
+
+def make_update(scenario: str, update_id: int, users: int) -> dict:
+    chat_id = BENCH_USER_ID + random.randrange(users)
+    if scenario == "start":
+        return make_message_update(update_id, chat_id, "/start")
+    if scenario == "getrec":
+        return make_message_update(update_id, chat_id, "/getrec")
+    if scenario == "moreinfo":
+        return make_callback_update(update_id, chat_id, random.randrange(BENCH_FILMS))
+    return make_message_update(update_id, chat_id, "/stat")
+
+
+def percentile(ordered: list, p: int) -> float:
+    return ordered[min(len(ordered) - 1, len(ordered) * p // 100)] if ordered else 0.0
+
+
+def handled_updates() -> int:
+    from metrics import metrics
+
+    # the metrics middleware only counts updates that reached a handler, dropped ones never start its timer
+    return sum(stats.count for name, stats in metrics.operations.items() if name.startswith("handler "))
+
+
+async def run_scenario(dp, scenario: str, requests: int, concurrency: int, users: int) -> dict:
+    from aiogram import types
+
+    semaphore = asyncio.Semaphore(concurrency)
+    # one update per chat at a time, as the bot processes them, so coalescing never drops a duplicate
+    chat_locks = dict()
+    latencies = []
+
+    async def one(update_id: int):
+        update = types.Update.to_object(make_update(scenario, update_id, users))
+        chat_id = (update.message or update.callback_query.message).chat.id
+        async with chat_locks.setdefault(chat_id, asyncio.Lock()), semaphore:
+            started = time.perf_counter()
+            await dp.process_update(update)
+            latencies.append(time.perf_counter() - started)
+
+    handled = handled_updates()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(update_id) for update_id in range(requests)))
+    elapsed = time.perf_counter() - started
+    handled = handled_updates() - handled
+
+    latencies.sort()
+    return {
+        "scenario": scenario,
+        "requests": requests,
+        "handled": handled,
+        "seconds": elapsed,
+        "throughput": handled / elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99)
+    }
+
+
+async def start_server(app: web.Application) -> tuple:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+async def main(args):
+    telegram = FakeTelegram(args.telegram_latency / 1000)
+    telegram_app = web.Application()
+    telegram_app.router.add_post("/bot{token}/{method}", telegram.handle)
+
+    backend_server = FakeBackend(args.backend_latency / 1000)
+    backend_app = web.Application()
+    backend_app.router.add_get("/user-data/get", backend_server.user_data)
+    backend_app.router.add_get("/actors/{id}/", backend_server.actor)
+    backend_app.router.add_get("/films/genres/{id}/", backend_server.genre)
+    backend_app.router.add_get("/films/", backend_server.films)
+    backend_app.router.add_get("/films/{id}/", backend_server.film)
+
+    telegram_runner, telegram_url = await start_server(telegram_app)
+    backend_runner, backend_url = await start_server(backend_app)
+
+    # the bot modules read their configuration at import time
+    os.environ.update({
+        "cinotes_bot_token": BENCH_TOKEN,
+        "cinotes_bot_owner_id": str(BENCH_OWNER_ID),
+        "cinotes_telegram_api_url": telegram_url,
+        "cinotes_backend_url": backend_url,
+        "cinotes_throttle_rate": str(10 ** 9),
+        "cinotes_throttle_burst": str(10 ** 9),
+    })
+    # Telegram's own limits would dominate every number, export lower ones to include the send scheduler
+    os.environ.setdefault("cinotes_send_rate", str(10 ** 9))
+    os.environ.setdefault("cinotes_send_burst", str(10 ** 9))
+    os.environ.setdefault("cinotes_chat_send_rate", str(10 ** 9))
+    os.environ.setdefault("cinotes_chat_send_burst", str(10 ** 9))
+    os.environ.setdefault("cinotes_log_to_file", "False")
+    os.environ.setdefault("cinotes_log_level", "WARNING")
+
+    import database
+    from aiogram import Bot, Dispatcher
+    import bot
+    from bot import dp, startup, shutdown
+    from sessions import roles
+
+    if args.postgres:
+        await startup(dp)
+    else:
+        memory = MemoryDatabase(args.db_latency / 1000)
+        database.db.open, database.db.close = memory.open, memory.close
+        database.db.execute, database.db.execute_values = memory.execute, memory.execute_values
+        await startup(dp, primary=False)
+
+    # every benchmark user is an admin account, so all scenarios pass their filters
+    exp = int(time.time()) + 86400
+    for user_id in range(BENCH_USER_ID, BENCH_USER_ID + args.users):
+        await database.cur_executor("INSERT INTO users(user_id, language) VALUES (%s, %s) ON CONFLICT (user_id) DO UPDATE SET language=EXCLUDED.language RETURNING (xmax = 0);", user_id, "en")
+        await database.cur_executor(
+            "INSERT INTO accounts(user_id, user_type, jwt, expire_on) VALUES (%s, %s, %s, %s) "
+            "ON CONFLICT (user_id) DO UPDATE SET user_type=EXCLUDED.user_type, jwt=EXCLUDED.jwt, expire_on=EXCLUDED.expire_on RETURNING user_id;",
+            user_id, "admin", fake_jwt(user_id, "admin", exp), exp
+        )
+
+    # seeding went around the handlers, so caches warmed at startup have to see it
+    await bot.warmup_task
+    roles.expire()
+
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+
+    print(f"{'scenario':<10} {'requests':>8} {'handled':>8} {'seconds':>8} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for scenario in args.scenarios:
+        result = await run_scenario(dp, scenario, args.requests, args.concurrency, args.users)
+        print(f"{result['scenario']:<10} {result['requests']:>8} {result['handled']:>8} {result['seconds']:>8.2f} {result['throughput']:>9.1f} "
+              f"{result['p50'] * 1000:>8.1f} {result['p95'] * 1000:>8.1f} {result['p99'] * 1000:>8.1f}")
+
+    print(f"\ntelegram calls: {telegram.calls}, owner alerts: {telegram.owner_messages}, backend calls: {backend_server.calls}")
+
+    await shutdown(dp)
+    session = await dp.bot.get_session()
+    await session.close()
+    await telegram_runner.cleanup()
+    await backend_runner.cleanup()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test of the bot dispatcher against local stand-ins for Telegram, the Cinotes backend and Postgres")
+    parser.add_argument("--scenarios", type=lambda value: value.split(","), default=list(SCENARIOS), help=f"comma separated, any of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=500, help="updates per scenario")
+    parser.add_argument("--concurrency", type=int, default=50, help="updates processed at the same time")
+    parser.add_argument("--users", type=int, default=100, help="distinct chats sending updates")
+    parser.add_argument("--telegram-latency", type=float, default=20, help="fake Bot API latency, ms")
+    parser.add_argument("--backend-latency", type=float, default=30, help="fake backend latency, ms")
+    parser.add_argument("--db-latency", type=float, default=1, help="in-memory database latency, ms")
+    parser.add_argument("--postgres", action="store_true", help="use the Postgres from cinotes_host/cinotes_user/... instead of the in-memory stand-in")
+
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
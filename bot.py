@@ -1,18 +1,37 @@
+import io
 import os
+import re
 import sys
 import json
 import base64
-import random
 import asyncio
-import requests
 import psycopg2
 import traceback
 
 from logger import log, LogMode
+from cache import TTLCache
+from stats import get_stats
+from sessions import sessions, roles, SessionLoadError
+from state import create_state
+from webhook import start_webhook
+from migrations import migrate
+from error_digest import error_digest
+from daily_push import daily_push, walk_subscribers
+from export import export_query, EXPORT_FORMAT, EXPORT_FORMATS, EXPORT_COMPRESS
+from throttling import ThrottlingMiddleware
+from metrics import metrics, MetricsMiddleware
+from outbound import scheduler, send_lane, ScheduledBot, ALERT_LANE, BULK_LANE
+from recommender import recommender
+from posters import posters, send_poster
+from usage_writer import usage_writer
+from backend import backend, catalog_cache, get_catalog
+from models import Film, Genre, Actor
+from database import db, cur_executor, connection_params
 from datetime import datetime
 from languages import TEXTS
 
-from aiogram import Bot as AiogramBot, Dispatcher, executor, types, exceptions as tg_exceptions
+from aiogram import Dispatcher, executor, types, exceptions as tg_exceptions
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.types.message import ContentTypes
 from aiogram.types.input_file import InputFile
 from aiogram.types.web_app_info import WebAppInfo
@@ -22,10 +41,23 @@ from aiogram.types.reply_keyboard import ReplyKeyboardMarkup, KeyboardButton, Re
 from aiogram.types.inline_keyboard import InlineKeyboardMarkup, InlineKeyboardButton
 
 
-bot = AiogramBot(os.environ["cinotes_bot_token"])
-dp = Dispatcher(bot)
+TELEGRAM_API_URL = os.environ.get("cinotes_telegram_api_url")
+
+bot = ScheduledBot(os.environ["cinotes_bot_token"], server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION)
+state = create_state()
+dp = Dispatcher(bot, storage=state.storage)
 BOT_OWNER_ID = int(os.environ["cinotes_bot_owner_id"])
-USERS_LANGS = dict()
+GETREC_MAX_COUNT = int(os.environ.get("cinotes_getrec_max_count", 5))
+JWT_REVALIDATE_INTERVAL = float(os.environ.get("cinotes_jwt_revalidate_interval", 300))
+JWT_VALIDATIONS = TTLCache(int(os.environ.get("cinotes_jwt_cache_size", 10000)), JWT_REVALIDATE_INTERVAL)
+STREAMABLE_QUERY = re.compile(r"\s*(SELECT|WITH|VALUES|TABLE)\b", re.IGNORECASE)
+# cursors cannot wrap data-modifying statements, not even inside a WITH clause
+DATA_MODIFYING_QUERY = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE)\b", re.IGNORECASE)
+BROADCAST_BATCH_SIZE = int(os.environ.get("cinotes_broadcast_batch_size", 100))
+
+warmup_task = None
+broadcast_task = None
+alert_tasks = set()
 
 
 class BotOwnerFilter(BoundFilter):
@@ -48,61 +80,65 @@ class BotAdminFilter(BoundFilter):
         self.is_admin = is_bot_admin
 
     async def check(self, message: types.Message):
-        res = cur_executor("SELECT user_type FROM accounts WHERE user_id=%s;", message.chat.id)
-        if res and isinstance(res[0], str):
-            log(f"Get error when check if user permitted to admin command: type: '{res[0]}', text: '{res[1]}'", LogMode.ERROR)
-            await bot.send_message(BOT_OWNER_ID, f"Админский фильтр упал из-за sql-ошибки: type: '{res[0]}', text: '{res[1]}'")
+        if message.chat.id == BOT_OWNER_ID:
+            return True
+
+        try:
+            return await roles.is_admin(message.chat.id)
+        except SessionLoadError as e:
+            log(f"Get error when check if user permitted to admin command: type: '{e.type}', text: '{e.text}'", LogMode.ERROR)
+            alert_owner(f"Админский фильтр упал из-за sql-ошибки: type: '{e.type}', text: '{e.text}'")
             return False
-        return res[0][0] == "admin" or message.chat.id == BOT_OWNER_ID
 
 
 dp.filters_factory.bind(BotAdminFilter)
+dp.middleware.setup(ThrottlingMiddleware({"getrec_func", "moreinfo_call"}))
+dp.middleware.setup(MetricsMiddleware())
 
+metrics.register_cache("catalog", catalog_cache)
+metrics.register_cache("sessions", sessions.cache)
+metrics.register_cache("jwt", JWT_VALIDATIONS)
+metrics.register_cache("seen", recommender.seen)
 
-async def get_lang(user_id: int):
-    global USERS_LANGS
-    if USERS_LANGS.get(user_id):
-        return USERS_LANGS.get(user_id)
-    
-    res = cur_executor("SELECT language FROM users WHERE user_id=%s;", user_id)
-    if isinstance(res[0], str):
-        await bot.send_message(BOT_OWNER_ID, f"Не удалось получить язык юзера из-за sql-ошибки: type: '{res[0]}', text: '{res[1]}'")
-        return "en"
-    
-    USERS_LANGS[user_id] = res[0][0]
-    return res[0][0]
 
+async def send_alert(text: str):
+    try:
+        with send_lane(ALERT_LANE):
+            if len(text) <= 4096:
+                await bot.send_message(BOT_OWNER_ID, text)
+            else:
+                await bot.send_document(BOT_OWNER_ID, InputFile(io.BytesIO(text.encode()), filename="error.txt"), caption="Перехвачена ошибка")
+    except Exception as e:
+        log(f"Get error when alerting owner: type: '{type(e).__name__}', text: '{e}'", LogMode.ERROR)
 
-def cur_executor(command: str, *args):
-    base = psycopg2.connect(
-        host=os.environ["cinotes_host"],
-        user=os.environ["cinotes_user"],
-        password=os.environ["cinotes_password"],
-        database=os.environ["cinotes_db_name"]    
-    )
 
-    base.autocommit = True
-    cur = base.cursor()
-    
+def alert_owner(text: str) -> asyncio.Task:
+    # alerts wait behind replies to users when the send rate is exhausted, so handlers never wait for them
+    task = asyncio.create_task(send_alert(text))
+    alert_tasks.add(task)
+    task.add_done_callback(alert_tasks.discard)
+    return task
+
+
+async def get_session(user_id: int):
     try:
-        cur.execute(command, args)
-        result = cur.fetchall()
-    except Exception as e:
-        return [type(e).__name__, str(e)]
-    finally:
-        if base:
-            cur.close()
-            base.close()
+        return await sessions.get(user_id)
+    except SessionLoadError as e:
+        log(f"Get error when loading session of user {user_id}: type: '{e.type}', text: '{e.text}'", LogMode.ERROR)
+        alert_owner(f"Не удалось получить данные юзера из-за sql-ошибки: type: '{e.type}', text: '{e.text}'")
+        return None
 
-    return result
 
+async def get_lang(user_id: int):
+    session = await get_session(user_id)
+    if session is None or not session.exists:
+        return "en"
 
-async def start_db():
-    conn = psycopg2.connect(
-        host=os.environ["cinotes_host"],
-        user=os.environ["cinotes_user"],
-        password=os.environ["cinotes_password"]  
-    )
+    return session.language
+
+
+def create_database():
+    conn = psycopg2.connect(**connection_params(with_database=False))
 
     conn.autocommit = True
 
@@ -111,54 +147,97 @@ async def start_db():
         log("Database successfully created", LogMode.OK)
     except psycopg2.errors.DuplicateDatabase:
         pass
-    conn.close()
-    
-    base = psycopg2.connect(
-        host=os.environ["cinotes_host"],
-        user=os.environ["cinotes_user"],
-        password=os.environ["cinotes_password"],
-        database=os.environ["cinotes_db_name"]    
-    )
-    base.autocommit = True
-    
-    if base:
-        log("Database successfully connected", LogMode.OK)
-        await bot.send_message(BOT_OWNER_ID, "Бот и база данных были успешно запущены")
-    else:
-        log("Database not connected", LogMode.ERROR)
-        await bot.send_message(BOT_OWNER_ID, "Бот был запущен, а база данных нет, дальнейшие действия с бд невозможны")
+    finally:
+        conn.close()
+
+
+async def start_db():
+    # the admin connection is only needed on the very first start, when the database does not exist yet
+    try:
+        try:
+            await db.open()
+        except psycopg2.OperationalError:
+            # server messages may be localized, so any failed connect tries to create the database once
+            create_database()
+            await db.open()
+    except psycopg2.Error as e:
+        log(f"Database not connected: type: '{type(e).__name__}', text: '{e}'", LogMode.ERROR)
+        alert_owner("Бот был запущен, а база данных нет, дальнейшие действия с бд невозможны")
         return
 
-    cur = base.cursor()
-    cur.execute("CREATE TABLE IF NOT EXISTS users(user_id BIGINT PRIMARY KEY NOT NULL, language TEXT NOT NULL);")
-    cur.execute("CREATE TABLE IF NOT EXISTS accounts(user_id BIGINT PRIMARY KEY NOT NULL, user_type TEXT NOT NULL, jwt TEXT NOT NULL, expire_on BIGINT NOT NULL);")
-    cur.execute("CREATE TABLE IF NOT EXISTS recommendation_system_usage(recommendation_id TEXT PRIMARY KEY NOT NULL, user_id BIGINT NOT NULL, on_date DATE NOT NULL, film_id BIGINT NOT NULL);")
+    log("Database successfully connected", LogMode.OK)
+    alert_owner("Бот и база данных были успешно запущены")
 
-    tu = cur_executor("SELECT * FROM users;")
-    if len(tu) == 0 or isinstance(tu[0], tuple):
-        log(f"Num of telegram users: {len(tu)}", LogMode.INFO)
-    else:
-        log(f"Get error in sql on start: type: '{tu[0]}', text: '{tu[1]}'", LogMode.ERROR)
+    res = await migrate()
+    if isinstance(res[0], str):
+        log(f"Get error when migrating database: type: '{res[0]}', text: '{res[1]}'", LogMode.ERROR)
+        alert_owner(f"Не удалось обновить схему базы данных: type: '{res[0]}', text: '{res[1]}'")
+        return
 
-    ta = cur_executor("SELECT * FROM accounts;")
-    if len(ta) == 0 or isinstance(ta[0], tuple):
-        log(f"Num of accounts: {len(ta)}", LogMode.INFO)
+    # planner estimates are read in constant time at any table size, exact counts are in /stat
+    res = await cur_executor("SELECT relname, GREATEST(reltuples, 0)::BIGINT FROM pg_class WHERE oid IN ('users'::regclass, 'accounts'::regclass);")
+    if isinstance(res[0], tuple):
+        counts = dict(res)
+        log(f"Num of telegram users: ~{counts.get('users', 0)}", LogMode.INFO)
+        log(f"Num of accounts: ~{counts.get('accounts', 0)}", LogMode.INFO)
     else:
-        log(f"Get error in sql on start: type: '{ta[0]}', text: '{ta[1]}'", LogMode.ERROR)
+        log(f"Get error in sql on start: type: '{res[0]}', text: '{res[1]}'", LogMode.ERROR)
 
 
-    if base:
-        cur.close()
-        base.close()
+async def warm_caches():
+    try:
+        await roles.reload()
+    except SessionLoadError as e:
+        log(f"Get error when warming roles: type: '{e.type}', text: '{e.text}'", LogMode.ERROR)
 
+    await posters.load()
 
-async def startup(dp):
+    try:
+        warmed = await sessions.warm()
+        log(f"Warmed sessions of {warmed} recently active users", LogMode.INFO)
+    except SessionLoadError as e:
+        log(f"Get error when warming sessions: type: '{e.type}', text: '{e.text}'", LogMode.ERROR)
+
+
+async def startup(dp, primary: bool = True, worker: int = 0):
     log("CINOTES BOT STARTED", LogMode.OK)
 
-    await start_db()
+    # extra workers share the database prepared by the primary one
+    if primary:
+        await start_db()
+    else:
+        await db.open()
+
+    await state.start()
+    usage_writer.start()
+    error_digest.start()
+    await metrics.start_server(worker=worker)
+
+    # one worker is enough to push, the others would send every pick again
+    if primary:
+        daily_push.start(daily_push_job)
+
+    # caches fill in the background, handlers fall back to the database until they are warm
+    global warmup_task
+    warmup_task = asyncio.create_task(warm_caches())
 
 
 async def shutdown(dp):
+    for task in (warmup_task, broadcast_task):
+        if task is not None:
+            task.cancel()
+    await metrics.stop_server()
+    await daily_push.stop()
+    await usage_writer.stop()
+    await error_digest.stop()
+    # queued alerts, the last digest among them, are delivered before the scheduler stops
+    if alert_tasks:
+        await asyncio.wait(alert_tasks)
+    await scheduler.stop()
+    await state.stop()
+    await backend.close()
+    await db.close()
+
     log("CINOTES BOT STOPED", LogMode.OK)
 
 
@@ -166,10 +245,9 @@ async def shutdown(dp):
 async def start_func(message: types.Message):
     log(f"Start pressed by user {message.chat.id}", LogMode.INFO)
 
-    res = cur_executor("SELECT * FROM users WHERE user_id=%s;", message.chat.id)
-    if res and isinstance(res[0], tuple):
-        lang = await get_lang(message.chat.id)
-        await message.answer(TEXTS[lang]["start_message"])
+    session = await get_session(message.chat.id)
+    if session and session.exists:
+        await message.answer(TEXTS[session.language]["start_message"])
     else:
         await bot.send_message(message.chat.id, "Обери мову бота / Choose bot language", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [
@@ -188,29 +266,29 @@ async def language_call(callback: types.CallbackQuery):
     lang = callback.data.split("_")[1]
     uid = callback.message.chat.id
 
-    global USERS_LANGS
-    USERS_LANGS[uid] = lang
-
-    lang = await get_lang(uid)
     await callback.message.edit_text(TEXTS[lang]["language_message"])
 
-    res = cur_executor("SELECT * FROM users WHERE user_id=%s;", uid)
-    if res and isinstance(res[0], tuple):
-        cur_executor("UPDATE users SET language=%s WHERE user_id=%s;", lang, uid)
-    else:
-        cur_executor("INSERT INTO users(user_id, language) VALUES (%s, %s);", uid, lang)
+    # xmax is zero only for freshly inserted rows
+    res = await cur_executor("INSERT INTO users(user_id, language) VALUES (%s, %s) ON CONFLICT (user_id) DO UPDATE SET language=EXCLUDED.language RETURNING (xmax = 0);", uid, lang)
+    if isinstance(res[0], str):
+        log(f"Get error when trying set language: type: '{res[0]}', text: '{res[1]}'", LogMode.ERROR)
+        return
+
+    sessions.set_language(uid, lang)
+
+    if res[0][0]:
         log(f"New user in database: {uid}", LogMode.OK)
-        tu = cur_executor("SELECT * FROM users;")
-        await bot.send_message(BOT_OWNER_ID, f"Новый пользователь в базе: {uid}\nСтало пользователей: {len(tu)}")
+        tu = await cur_executor("SELECT COUNT(*) FROM users;")
+        alert_owner(f"Новый пользователь в базе: {uid}\nСтало пользователей: {tu[0][0]}")
     
         await bot.send_message(uid, TEXTS[lang]["start_message"])
 
 
 async def check_user_in_db(uid: int) -> bool:
-    res = bool(cur_executor("SELECT user_id FROM users WHERE user_id=%s;", uid))
+    session = await get_session(uid)
+    res = bool(session and session.exists)
     if not res:
-        lang = await get_lang(uid)
-        await bot.send_message(uid, TEXTS[lang]["user_not_in_db_error"])
+        await bot.send_message(uid, TEXTS["en"]["user_not_in_db_error"])
     return res
 
 
@@ -247,10 +325,10 @@ async def login_func(message: types.Message):
     if not await check_user_in_db(message.chat.id):
         return
 
-    lang = await get_lang(message.chat.id)
+    session = await get_session(message.chat.id)
+    lang = session.language
 
-    res = cur_executor("SELECT user_id FROM accounts WHERE user_id=%s;", message.chat.id)
-    if res and isinstance(res[0], tuple):
+    if session.logged_in:
         await bot.send_message(message.chat.id, TEXTS[lang]["already_logged_in"])
         return
 
@@ -270,32 +348,39 @@ async def logout_func(message: types.Message):
     if not await check_user_in_db(message.chat.id):
         return
 
-    lang = await get_lang(message.chat.id)
+    session = await get_session(message.chat.id)
+    lang = session.language
 
-    res = cur_executor("SELECT user_id FROM accounts WHERE user_id=%s;", message.chat.id)
-    if not res:
+    if not session.logged_in:
         await bot.send_message(message.chat.id, TEXTS[lang]["not_logged_in"])
         return
-    if isinstance(res[0], tuple):
-        cur_executor("DELETE FROM accounts WHERE user_id=%s;", message.chat.id)
-        await bot.send_message(message.chat.id, TEXTS[lang]["success_logout"])
+
+    res = await cur_executor("DELETE FROM accounts WHERE user_id=%s RETURNING user_id;", message.chat.id)
+    if res and isinstance(res[0], str):
+        log(f"Get error when trying delete account from db: type: '{res[0]}', text: '{res[1]}'", LogMode.ERROR)
+        await bot.send_message(message.chat.id, TEXTS[lang]["unknown_bot_error"])
         return
 
+    sessions.remove_account(message.chat.id)
+    roles.remove(message.chat.id)
+    await bot.send_message(message.chat.id, TEXTS[lang]["success_logout"])
+
 
 async def add_account_to_db(user_id: int, user_type: str, jwt: str, expire_on: int):
     log(f"Trying add to db account of user {user_id} with type '{user_type}' and jwt '{jwt}'", LogMode.INFO)
 
-    res = cur_executor("SELECT user_id FROM accounts WHERE user_id=%s;", user_id)
+    res = await cur_executor(
+        "INSERT INTO accounts(user_id, user_type, jwt, expire_on) VALUES (%s, %s, %s, %s) "
+        "ON CONFLICT (user_id) DO UPDATE SET user_type=EXCLUDED.user_type, jwt=EXCLUDED.jwt, expire_on=EXCLUDED.expire_on RETURNING user_id;",
+        user_id, user_type, jwt, expire_on
+    )
     if res and isinstance(res[0], str):
         log(f"Get error when trying add account to db: type: '{res[0]}', text: '{res[1]}'", LogMode.ERROR)
         return False
-    
-    if res and isinstance(res[0], tuple):
-        cur_executor("UPDATE accounts SET user_type=%s, jwt=%s, expire_on=%s WHERE user_id=%s;", user_type, jwt, expire_on, user_id)
-        return True
-    else:
-        cur_executor("INSERT INTO accounts(user_id, user_type, jwt, expire_on) VALUES (%s, %s, %s, %s);", user_id, user_type, jwt, expire_on)
-        return True
+
+    sessions.set_account(user_id, user_type, jwt, expire_on)
+    roles.set_role(user_id, user_type)
+    return True
 
 
 @dp.message_handler(content_types="web_app_data")
@@ -316,7 +401,7 @@ async def handle_web_app_data_func(message :types.Message):
         "password": password
     }
 
-    response = requests.post("https://back.cintoes.link/auth/signin", json=data)
+    response = await backend.post("/auth/signin", data)
 
     if response.status_code != 200:
         if response.status_code == 404 and "no user with such email" in response.text:
@@ -336,10 +421,7 @@ async def handle_web_app_data_func(message :types.Message):
         jwt: str = response.json()["jwt"]
         log(f"JWT: '{jwt}'", LogMode.OK)
         await temp.edit_text(TEXTS[lang]["success_login"])
-        parts = jwt.split(".")
-
-        data_str = base64.b64decode(parts[1] + "=" * (4-(len(parts[1]) % 4))).decode("utf-8")
-        data = json.loads(data_str)
+        data = decode_jwt(jwt)
         dt = datetime.fromtimestamp(data["exp"])
 
         await message.answer(TEXTS[lang]["jwt_expire_on"].format(dt=dt), reply_markup=ReplyKeyboardRemove())
@@ -364,58 +446,92 @@ async def handle_web_app_data_func(message :types.Message):
 
 
 async def get_data(jwt: str, path: str, **kwargs):
-    url = "https://back.cintoes.link" + path
-
-    if kwargs:
-        url += "?"
-        for k, v in kwargs.items():
-            url += f"{k}={v}&"
-        
-        url = url[:-1]
+    response = await backend.get(path, jwt, **kwargs)
 
-    headers = {
-        "Authorization": "Bearer " + jwt
-    }
+    return response.status_code, response
 
-    response = requests.get(url, headers=headers)
 
-    return response.status_code, response
+def decode_jwt(jwt: str) -> dict:
+    parts = jwt.split(".")
+    data_str = base64.b64decode(parts[1] + "=" * (4-(len(parts[1]) % 4))).decode("utf-8")
+    return json.loads(data_str)
 
 
 async def bypass_jwt(uid: int, message: types.Message):
-    lang = await get_lang(uid)
-    
-    res = cur_executor("SELECT jwt FROM accounts WHERE user_id=%s;", uid)
-    if not res:
+    session = await get_session(uid)
+    if session is None:
+        await message.answer(TEXTS["en"]["unknown_bot_error"])
+        return None, None
+
+    lang = session.language or "en"
+
+    if not session.logged_in:
         await message.answer(TEXTS[lang]["not_authorized"])
         return None, None
 
-    if isinstance(res[0], str):
-        log(f"Get error when trying get jwt from db: type: '{res[0]}', text: '{res[1]}'", LogMode.ERROR)
-        await message.answer(TEXTS[lang]["unknown_bot_error"])
-        await bot.send_message(BOT_OWNER_ID, f"Произошла ошибка во время проверки jwt: type: '{res[0]}', text: '{res[1]}'")
+    jwt, expire_on = session.jwt, session.expire_on
+    data = decode_jwt(jwt)
+
+    ttl = min(JWT_REVALIDATE_INTERVAL, expire_on - datetime.now().timestamp())
+    if ttl <= 0:
+        JWT_VALIDATIONS.pop(jwt)
+        await message.answer(TEXTS[lang]["token_not_valid"])
+        await cur_executor("DELETE FROM accounts WHERE user_id=%s;", uid)
+        sessions.remove_account(uid)
+        roles.remove(uid)
         return None, None
-    
-    jwt = res[0][0]
 
-    parts = jwt.split(".")
-    data_str = base64.b64decode(parts[1] + "=" * (4-(len(parts[1]) % 4))).decode("utf-8")
-    data = json.loads(data_str)
+    # the hit rate is counted here, where the cache decides whether the backend is asked again
+    if JWT_VALIDATIONS.get(jwt) is not None:
+        return jwt, data
 
     check_jwt = await get_data(jwt, "/user-data/get", user_id=data["id"])
 
     if check_jwt[0] != 200:
         await message.answer(TEXTS[lang]["token_not_valid"])
-        cur_executor("DELETE FROM accounts WHERE user_id=%s;", uid)
+        await cur_executor("DELETE FROM accounts WHERE user_id=%s;", uid)
+        sessions.remove_account(uid)
+        roles.remove(uid)
         return None, None
+
+    # the validation response is the user's profile, so it is kept for get_profile
+    JWT_VALIDATIONS.set(jwt, check_jwt[1].json(), ttl=ttl)
     
     return jwt, data
 
 
-def gen_rand_text():
-    alph = list("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz")
-    random.shuffle(alph)
-    return "".join(alph[:10])
+async def get_profile(jwt: str, jwt_data: dict) -> dict:
+    profile = JWT_VALIDATIONS.peek(jwt)
+    if profile is None:
+        profile = (await get_data(jwt, "/user-data/get", user_id=jwt_data["id"]))[1].json()
+    return profile
+
+
+async def get_favorites(jwt: str, profile: dict):
+    async def get_genre_films():
+        fav_genre = await get_catalog(Genre, f"/films/genres/{profile['FavGenre']}/", jwt)
+        pool = await recommender.get_pool(fav_genre.title, jwt)
+        return fav_genre, pool
+
+    # genre films depend only on the genre, so they are fetched while actor and film are still in flight
+    return await asyncio.gather(
+        get_catalog(Actor, f"/actors/{profile['FavActor']}/", jwt),
+        get_genre_films(),
+        get_catalog(Film, f"/films/{profile['FavFilm']}/", jwt),
+        return_exceptions=True
+    )
+
+
+async def send_recommendation(uid: int, lang: str, film: Film) -> types.Message:
+    return await send_poster(bot, uid, film.id, film.poster, caption=film.title,
+        caption_entities=[
+            MessageEntity(MessageEntityType.TEXT_LINK, 0, len(film.title), film.link)
+        ],
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [
+                InlineKeyboardButton(TEXTS[lang]["more_info_button_text"], callback_data=f"moreinfo_{film.id}")
+            ]
+        ]))
 
 
 @dp.message_handler(commands=["getrec"])
@@ -427,50 +543,45 @@ async def getrec_func(message: types.Message):
 
     uid = message.chat.id
     lang = await get_lang(uid)
+
+    args = message.get_args()
+    count = int(args) if args.isdigit() else (0 if args else 1)
+    if not 1 <= count <= GETREC_MAX_COUNT:
+        await message.answer(TEXTS[lang]["getrec_count_error"].format(max_count=GETREC_MAX_COUNT))
+        return
     
     jwt, jwt_data = await bypass_jwt(uid, message)
     if not jwt:
         return
     
-    profile = (await get_data(jwt, "/user-data/get", user_id=jwt_data["id"]))[1].json()
+    profile = await get_profile(jwt, jwt_data)
 
-    fav_actor = await get_data(jwt, f"/actors/{profile['FavActor']}/")
-    fav_genre = await get_data(jwt, f"/films/genres/{profile['FavGenre']}/")
-    fav_film = await get_data(jwt, f"/films/{profile['FavFilm']}/")
+    favorites = dict(zip(("actor", "genre", "film"), await get_favorites(jwt, profile)))
 
-    try:
-        fav_actor = fav_actor[1].json()
-        fav_genre = fav_genre[1].json()
-        fav_film = fav_film[1].json()
-        if {'detail': 'Not found.'} in [fav_actor, fav_genre, fav_film]:
-            raise ValueError
-    except (requests.exceptions.JSONDecodeError, ValueError):
-        log(f"Get JSONDecodeError when feching favorites from users account: fav_actor_id: '{profile['FavActor']}', fav_genre_id: '{profile['FavGenre']}', fav_film_id: '{profile['FavFilm']}'", LogMode.ERROR)
+    failed = {name: result for name, result in favorites.items() if isinstance(result, Exception)}
+    if failed:
+        errors = ", ".join(f"{name}: {type(e).__name__}" for name, e in failed.items())
+        log(f"Get error when feching favorites from users account ({errors}): fav_actor_id: '{profile['FavActor']}', fav_genre_id: '{profile['FavGenre']}', fav_film_id: '{profile['FavFilm']}'", LogMode.ERROR)
         await message.answer(TEXTS[lang]["unknown_bot_error"])
-        await bot.send_message(BOT_OWNER_ID, f"Произошла ошибка во время сбора данных с аккаунта юзера: fav_actor_id: '{profile['FavActor']}', fav_genre_id: '{profile['FavGenre']}', fav_film_id: '{profile['FavFilm']}'")
+        alert_owner(f"Произошла ошибка во время сбора данных с аккаунта юзера ({', '.join(failed)}): fav_actor_id: '{profile['FavActor']}', fav_genre_id: '{profile['FavGenre']}', fav_film_id: '{profile['FavFilm']}'")
         return
 
-    films = (await get_data(jwt, "/films/", genre=fav_genre["title"], page_size=200))[1].json()
+    fav_genre, pool = favorites["genre"]
+    seen = await recommender.get_seen(uid)
 
-    random.shuffle(films["results"])
+    picked = recommender.pick(pool, seen, count)
 
-    for short_film in films["results"][:1]:
-        await bot.send_photo(uid, short_film["poster_file"], caption=short_film["title"],
-            caption_entities=[
-                MessageEntity(MessageEntityType.TEXT_LINK, 0, len(short_film["title"]), f"https://cintoes.link/films/{short_film['url'].split('/films/')[-1].split('/')[0]}")
-            ],
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [
-                    InlineKeyboardButton(TEXTS[lang]["more_info_button_text"], callback_data=f"moreinfo_{short_film['url'].split('/films/')[-1].split('/')[0]}")
-                ]
-            ]))
+    # media groups cannot carry the "more info" buttons, so the photos are sent as pipelined requests instead
+    results = await asyncio.gather(*(send_recommendation(uid, lang, film) for film in picked), return_exceptions=True)
 
-        while True:
-            recommendation_id = gen_rand_text()
-            if not cur_executor("SELECT * FROM recommendation_system_usage WHERE recommendation_id=%s;", recommendation_id):
-                break
+    sent = [film.id for film, result in zip(picked, results) if not isinstance(result, Exception)]
+    usage_writer.record_many([(uid, film_id) for film_id in sent])
+    for film_id in sent:
+        recommender.mark_seen(uid, film_id)
 
-        cur_executor("INSERT INTO recommendation_system_usage(recommendation_id, user_id, on_date, film_id) VALUES (%s, %s, %s, %s);", recommendation_id, uid, datetime.now().date(), short_film['url'].split('/films/')[-1].split('/')[0])
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
 
 
 @dp.callback_query_handler(Text(startswith="moreinfo_"))
@@ -488,23 +599,21 @@ async def moreinfo_call(callback: types.CallbackQuery):
     if not jwt:
         return
 
-    film = await get_data(jwt, f"/films/{film_id}/")
-
-    if film[0] != 200 or {'detail': 'Not found.'} in film:
+    try:
+        film = await get_catalog(Film, f"/films/{film_id}/", jwt)
+    except (LookupError, ValueError):
         await callback.answer(TEXTS[lang]["film_not_found"])
         return
 
-    film_data = film[1].json()
-
     text = TEXTS[lang]["full_info_text"].format(
         name=callback.message.caption,
-        country=film_data["country"],
-        release_date=film_data["release_date"],
-        rating=film_data["rating"],
-        imdb_rating=film_data["imdb_rating"],
-        genres=", ".join(map(lambda x: x["title"], film_data["genres"])),
-        studio=film_data["studio"],
-        director=film_data["director"]
+        country=film.country,
+        release_date=film.release_date,
+        rating=film.rating,
+        imdb_rating=film.imdb_rating,
+        genres=", ".join(film.genres),
+        studio=film.studio,
+        director=film.director
     )
 
     await callback.message.edit_caption(text, caption_entities=[
@@ -512,6 +621,91 @@ async def moreinfo_call(callback: types.CallbackQuery):
             ])
 
 
+async def push_daily_batch(rows: list) -> int:
+    now = datetime.now().timestamp()
+    users = [(uid, jwt, lang) for uid, jwt, expire_on, lang in rows if expire_on > now]
+
+    async def get_fav_genre(jwt: str):
+        return (await get_profile(jwt, decode_jwt(jwt)))["FavGenre"]
+
+    fav_genres = await asyncio.gather(*(get_fav_genre(jwt) for _, jwt, _ in users), return_exceptions=True)
+
+    # users with the same favorite genre share one genre lookup and one film pool
+    by_genre = dict()
+    for user, fav_genre in zip(users, fav_genres):
+        if isinstance(fav_genre, Exception):
+            log(f"Skipped daily push to user {user[0]}, profile not loaded: type: '{type(fav_genre).__name__}', text: '{fav_genre}'", LogMode.WARNING)
+            continue
+        by_genre.setdefault(fav_genre, []).append(user)
+
+    seen = await recommender.get_seen_many([uid for genre_users in by_genre.values() for uid, _, _ in genre_users])
+
+    sent = []
+    for genre_id, genre_users in by_genre.items():
+        jwt = genre_users[0][1]
+        try:
+            fav_genre = await get_catalog(Genre, f"/films/genres/{genre_id}/", jwt)
+            pool = await recommender.get_pool(fav_genre.title, jwt)
+        except Exception as e:
+            log(f"Skipped daily push to {len(genre_users)} users of genre {genre_id}: type: '{type(e).__name__}', text: '{e}'", LogMode.ERROR)
+            continue
+
+        async def deliver(uid: int, lang: str):
+            picked = recommender.pick(pool, seen[uid])
+            if not picked:
+                return None
+
+            await bot.send_message(uid, TEXTS[lang]["daily_push_message"])
+            await send_recommendation(uid, lang, picked[0])
+            return picked[0].id
+
+        # the scheduler paces the push, so it never takes rate from users talking to the bot
+        with send_lane(BULK_LANE):
+            results = await asyncio.gather(*(deliver(uid, lang) for uid, _, lang in genre_users), return_exceptions=True)
+
+        for (uid, _, _), result in zip(genre_users, results):
+            if isinstance(result, Exception):
+                log(f"Daily push not delivered to user {uid}: type: '{type(result).__name__}', text: '{result}'", LogMode.WARNING)
+            elif result is not None:
+                sent.append((uid, result))
+                recommender.mark_seen(uid, result)
+
+    usage_writer.record_many(sent)
+    return len(sent)
+
+
+async def daily_push_job() -> int:
+    log("Daily push started", LogMode.INFO)
+
+    sent = 0
+    async for rows in walk_subscribers():
+        sent += await push_daily_batch(rows)
+    return sent
+
+
+@dp.message_handler(commands=["daily"])
+async def daily_func(message: types.Message):
+    log(f"Trying toggle daily push by user {message.chat.id}", LogMode.INFO)
+
+    if not await check_user_in_db(message.chat.id):
+        return
+
+    session = await get_session(message.chat.id)
+    lang = session.language
+
+    if session.user_type != "premium":
+        await message.answer(TEXTS[lang]["daily_premium_only"])
+        return
+
+    res = await cur_executor("UPDATE users SET daily_push = NOT daily_push WHERE user_id=%s RETURNING daily_push;", message.chat.id)
+    if not res or isinstance(res[0], str):
+        log(f"Get error when toggling daily push of user {message.chat.id}: {res}", LogMode.ERROR)
+        await message.answer(TEXTS[lang]["unknown_bot_error"])
+        return
+
+    await message.answer(TEXTS[lang]["daily_enabled" if res[0][0] else "daily_disabled"])
+
+
 @dp.message_handler(is_bot_admin=True, commands=["admin"])
 async def admin_func(message: types.Message):
     log(f"Get admin by user {message.chat.id}", LogMode.INFO)
@@ -532,25 +726,91 @@ async def stat_func(message: types.Message):
 
     lang = await get_lang(message.chat.id)
 
-    total_users = len(cur_executor("SELECT user_id FROM users;"))
-
-    total_accounts = len(cur_executor("SELECT user_id FROM accounts;"))
-    admin_accounts = len(cur_executor("SELECT user_id FROM accounts WHERE user_type='admin';"))
-    premium_accounts = len(cur_executor("SELECT user_id FROM accounts WHERE user_type='premium';"))
-
-    total_recommendations = len(cur_executor("SELECT recommendation_id FROM recommendation_system_usage;"))
-    recommendations_today = len(cur_executor("SELECT recommendation_id FROM recommendation_system_usage WHERE on_date=%s;", datetime.now().date()))
+    stats = await get_stats()
+    if isinstance(stats, list):
+        log(f"Get error when collecting stat: type: '{stats[0]}', text: '{stats[1]}'", LogMode.ERROR)
+        await message.answer(TEXTS[lang]["unknown_bot_error"])
+        return
 
     await message.answer(TEXTS[lang]["stat_message"].format(
-            total_users=total_users,
-            total_accounts=total_accounts,
-            admin_accounts=admin_accounts,
-            premium_accounts=premium_accounts,
-            total_recommendations=total_recommendations,
-            recommendations_today=recommendations_today
+            **stats,
+            days="\n".join(f"{day}: {count}" for day, count in stats["recommendations_by_day"]) or "-",
+            users="\n".join(f"{user_id}: {count}" for user_id, count in stats["top_users"]) or "-",
+            catalog_cache_hits=catalog_cache.hits,
+            catalog_cache_misses=catalog_cache.misses,
+            catalog_cache_size=len(catalog_cache)
         ))
 
 
+@dp.message_handler(is_bot_admin=True, commands=["metrics"])
+async def metrics_func(message: types.Message):
+    log(f"Get metrics by user {message.chat.id}", LogMode.INFO)
+
+    if not await check_user_in_db(message.chat.id):
+        return
+
+    text = metrics.render_text()
+    if len(text) > 4096:
+        await message.answer_document(InputFile(io.BytesIO(text.encode()), filename="metrics.txt"))
+    else:
+        await message.answer(text)
+
+
+async def run_broadcast(admin_id: int, lang: str, text: str):
+    sent, failed = 0, 0
+    last_user_id = -2 ** 63
+
+    # keyset pagination keeps every page an index range scan, however many users there are
+    while True:
+        res = await cur_executor("SELECT user_id FROM users WHERE user_id > %s ORDER BY user_id LIMIT %s;", last_user_id, BROADCAST_BATCH_SIZE)
+        if res and isinstance(res[0], str):
+            log(f"Get error when walking users for broadcast: type: '{res[0]}', text: '{res[1]}'", LogMode.ERROR)
+            alert_owner(f"Рассылка остановлена из-за sql-ошибки: type: '{res[0]}', text: '{res[1]}'")
+            break
+        if not res:
+            break
+
+        # the scheduler paces the batch, replies to users and alerts overtake it
+        with send_lane(BULK_LANE):
+            results = await asyncio.gather(*(bot.send_message(user_id, text) for (user_id,) in res), return_exceptions=True)
+
+        for (user_id,), result in zip(res, results):
+            if isinstance(result, Exception):
+                failed += 1
+                log(f"Broadcast not delivered to user {user_id}: type: '{type(result).__name__}', text: '{result}'", LogMode.WARNING)
+            else:
+                sent += 1
+
+        last_user_id = res[-1][0]
+
+    log(f"Broadcast finished: sent: {sent}, failed: {failed}", LogMode.OK)
+    await bot.send_message(admin_id, TEXTS[lang]["broadcast_finished"].format(sent=sent, failed=failed))
+
+
+@dp.message_handler(is_bot_admin=True, commands=["broadcast"])
+async def broadcast_func(message: types.Message):
+    log(f"Trying start broadcast by user {message.chat.id}", LogMode.INFO)
+
+    if not await check_user_in_db(message.chat.id):
+        return
+
+    lang = await get_lang(message.chat.id)
+
+    text = message.get_args()
+    if not text:
+        await message.answer(TEXTS[lang]["broadcast_usage"])
+        return
+
+    global broadcast_task
+    if broadcast_task is not None and not broadcast_task.done():
+        await message.answer(TEXTS[lang]["broadcast_in_progress"])
+        return
+
+    # the broadcast outlives the update, so the admin's chat is not blocked until it ends
+    broadcast_task = asyncio.create_task(run_broadcast(message.chat.id, lang, text))
+    await message.answer(TEXTS[lang]["broadcast_started"])
+
+
 @dp.message_handler(is_bot_owner=True, commands=["stop"])
 async def stop_func(message: types.Message):
     log("Trying stop bot", LogMode.INFO)
@@ -564,6 +824,7 @@ async def stop_func(message: types.Message):
         await asyncio.sleep(3)
 
         dp.stop_polling()
+        await usage_writer.stop()
         await dp.storage.close()
         await dp.storage.wait_closed()
         session = await dp.bot.get_session()
@@ -592,23 +853,48 @@ async def sqlexecute_func(message: types.Message):
         await message.reply("Требуется параметр в виде строки")
         return
 
-    result = cur_executor(query)
-    if result == ['ProgrammingError', 'no results to fetch'] or not result:
-        await message.reply("Запрос не вернул никаких данных")
-    elif result[0] and result[0] == "UniqueViolation":
-        await message.reply("Такие данные уже есть в бд")
-    elif result[0] and isinstance(result[0], str):
+    # leading words csv, jsonl and gz choose the export file: /sqlexecute jsonl gz SELECT ...
+    fmt, compress = EXPORT_FORMAT, EXPORT_COMPRESS
+    words = query.split(maxsplit=1)
+    while len(words) == 2 and words[0].lower() in (*EXPORT_FORMATS, "gz"):
+        if words[0].lower() == "gz":
+            compress = True
+        else:
+            fmt = words[0].lower()
+        query = words[1]
+        words = query.split(maxsplit=1)
+
+    # only queries that can run behind a cursor are streamed, the rest return little and are fetched at once
+    if not STREAMABLE_QUERY.match(query) or DATA_MODIFYING_QUERY.search(query):
+        result = await cur_executor(query)
+        if result == ['ProgrammingError', 'no results to fetch'] or not result:
+            await message.reply("Запрос не вернул никаких данных")
+        elif result[0] and result[0] == "UniqueViolation":
+            await message.reply("Такие данные уже есть в бд")
+        elif result[0] and isinstance(result[0], str):
+            await message.reply(f"Произошла ошибка во время выполнения запроса:\nТип: '{result[0]}'\nТекст: '{result[1]}'")
+        else:
+            await message.reply_document(InputFile(io.BytesIO(str(result).encode()), filename="result.txt"), caption="Результат выполнения запроса в файле")
+        return
+
+    result = await export_query(query, fmt, compress)
+    if isinstance(result, list):
         await message.reply(f"Произошла ошибка во время выполнения запроса:\nТип: '{result[0]}'\nТекст: '{result[1]}'")
-    else:
-        with open("tempfile.txt", "w") as f:
-            f.write(str(result))
-        
-        await message.reply_document(InputFile("tempfile.txt"), caption="Результат выполнения запроса в файле")
-        
-        try:
-            os.remove("tempfile.txt")
-        except:
-            pass
+        return
+
+    try:
+        if not result.rows:
+            await message.reply("Запрос не вернул никаких данных")
+            return
+
+        caption = "Результат выполнения запроса в файле"
+        if result.truncated:
+            caption += f"\nВыгрузка остановлена по лимиту строк или времени после {result.rows} строк"
+
+        with open(result.path, "rb") as f:
+            await message.reply_document(InputFile(f, filename=result.filename), caption=caption)
+    finally:
+        result.remove()
 
 
 @dp.message_handler(content_types=['text'])
@@ -627,27 +913,27 @@ async def other_handler(message: types.Message):
     await message.answer(TEXTS[lang]["get_unknown_type_of_message"])
 
 
+async def send_error_alert(text: str):
+    alert_owner(text)
+
+
+error_digest.send = send_error_alert
+
+
 @dp.errors_handler()
 async def errors_handler(update: types.Update, e: Exception):
-    text = f"Catch error:\n\nUpdate: {update}\n\n{''.join(traceback.format_exception(*sys.exc_info())).strip()}"
-
-    log(text, LogMode.ERROR)
+    log(f"Catch error:\n\nUpdate: {update}\n\n{''.join(traceback.format_exception(*sys.exc_info())).strip()}", LogMode.ERROR)
 
     try:
-        await bot.send_message(BOT_OWNER_ID, text)
-    except tg_exceptions.MessageIsTooLong:
-        with open("tempfile.txt", "w") as f:
-            f.write(text)
-        
-        await bot.send_document(BOT_OWNER_ID, InputFile("tempfile.txt"), caption="Перехвачена ошибка")
-        
-        try:
-            os.remove("tempfile.txt")
-        except:
-            pass
+        await error_digest.report(update, e)
+    except Exception as send_error:
+        log(f"Get error when alerting owner about error: type: '{type(send_error).__name__}', text: '{send_error}'", LogMode.ERROR)
 
     return True
 
 
 if __name__ == "__main__":
-    executor.start_polling(dp, on_startup=startup, on_shutdown=shutdown)
+    if os.environ.get("cinotes_mode", "polling") == "webhook":
+        start_webhook(dp, on_startup=startup, on_shutdown=shutdown)
+    else:
+        executor.start_polling(dp, on_startup=startup, on_shutdown=shutdown)
@@ -0,0 +1,97 @@
+import asyncio
+
+from time import monotonic
+from collections import OrderedDict
+
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._data = OrderedDict()
+        self._pending = dict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+
+        if item[0] < monotonic():
+            del self._data[key]
+            return None
+
+        self._data.move_to_end(key)
+        return item
+
+    def get(self, key, default=None):
+        item = self._lookup(key)
+        if item is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return item[1]
+
+    def peek(self, key, default=None):
+        item = self._lookup(key)
+        return default if item is None else item[1]
+
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    async def get_or_fetch(self, key, fetch):
+        item = self._lookup(key)
+        if item is not None:
+            self.hits += 1
+            return item[1]
+
+        # concurrent misses for the same key wait for the first fetch instead of repeating it
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.hits += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+
+        try:
+            value = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        else:
+            self.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            del self._pending[key]
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
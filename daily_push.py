@@ -0,0 +1,77 @@
+import os
+import asyncio
+
+from time import monotonic
+from logger import log, LogMode
+from database import cur_executor
+from datetime import datetime, timedelta
+
+
+DAILY_PUSH_HOUR = int(os.environ.get("cinotes_daily_push_hour", 4))
+DAILY_PUSH_BATCH_SIZE = int(os.environ.get("cinotes_daily_push_batch_size", 200))
+
+# keyset pages over accounts, the partial index keeps opted-out users out of the scan
+SUBSCRIBERS_QUERY = (
+    "SELECT a.user_id, a.jwt, a.expire_on, u.language FROM accounts a JOIN users u ON u.user_id = a.user_id "
+    "WHERE a.user_id > %s AND a.user_type='premium' AND u.daily_push ORDER BY a.user_id LIMIT %s;"
+)
+
+
+def seconds_until(hour: int) -> float:
+    now = datetime.now()
+    run_at = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    if run_at <= now:
+        run_at += timedelta(days=1)
+    return (run_at - now).total_seconds()
+
+
+async def walk_subscribers(batch_size: int = DAILY_PUSH_BATCH_SIZE):
+    last_user_id = -2 ** 63
+    while True:
+        res = await cur_executor(SUBSCRIBERS_QUERY, last_user_id, batch_size)
+        if res and isinstance(res[0], str):
+            log(f"Get error when walking daily push subscribers: type: '{res[0]}', text: '{res[1]}'", LogMode.ERROR)
+            return
+        if not res:
+            return
+
+        yield res
+        last_user_id = res[-1][0]
+
+
+class DailyPush:
+    def __init__(self, hour: int = DAILY_PUSH_HOUR):
+        self.hour = hour
+
+        self._job = None
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(seconds_until(self.hour))
+
+            started = monotonic()
+            try:
+                sent = await self._job()
+            except Exception as e:
+                log(f"Get error in daily push: type: '{type(e).__name__}', text: '{e}'", LogMode.ERROR)
+            else:
+                log(f"Daily push sent {sent} recommendations in {monotonic() - started:.1f} seconds", LogMode.OK)
+
+    def start(self, job):
+        self._job = job
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            log(f"Daily push scheduled at {self.hour}:00", LogMode.INFO)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+daily_push = DailyPush()
@@ -0,0 +1,190 @@
+import os
+import asyncio
+import psycopg2
+import psycopg2.pool
+import psycopg2.extras
+
+from metrics import metrics
+from logger import log, LogMode
+from uuid import uuid4
+from time import monotonic, perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+DB_POOL_MIN_SIZE = int(os.environ.get("cinotes_db_pool_min", 1))
+DB_POOL_MAX_SIZE = int(os.environ.get("cinotes_db_pool_max", 10))
+DB_HEALTH_CHECK_INTERVAL = float(os.environ.get("cinotes_db_health_check_interval", 30))
+
+
+def connection_params(with_database: bool = True) -> dict:
+    params = {
+        "host": os.environ["cinotes_host"],
+        "user": os.environ["cinotes_user"],
+        "password": os.environ["cinotes_password"]
+    }
+
+    if with_database:
+        params["database"] = os.environ["cinotes_db_name"]
+
+    return params
+
+
+class DatabasePool:
+    def __init__(self, min_size: int = DB_POOL_MIN_SIZE, max_size: int = DB_POOL_MAX_SIZE, health_check_interval: float = DB_HEALTH_CHECK_INTERVAL):
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.health_check_interval = health_check_interval
+
+        self._pool = None
+        self._last_used = dict()
+        # one worker thread per connection, so the pool can never be exhausted
+        self._executor = ThreadPoolExecutor(max_workers=self.max_size, thread_name_prefix="cinotes-db")
+
+    @property
+    def opened(self) -> bool:
+        return self._pool is not None and not self._pool.closed
+
+    def _open(self):
+        if self.opened:
+            return
+        self._pool = psycopg2.pool.ThreadedConnectionPool(self.min_size, self.max_size, **connection_params())
+        log(f"Database pool opened: min size: {self.min_size}, max size: {self.max_size}", LogMode.OK)
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+
+        last_used = self._last_used.get(id(conn))
+        if last_used is None or monotonic() - last_used < self.health_check_interval:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _getconn(self):
+        self._open()
+
+        for _ in range(self.max_size + 1):
+            conn = self._pool.getconn()
+            if self._is_healthy(conn):
+                conn.autocommit = True
+                return conn
+
+            log("Dropped broken connection from database pool", LogMode.WARNING)
+            self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=True)
+
+        raise psycopg2.OperationalError("no healthy connection in database pool")
+
+    def _putconn(self, conn):
+        if conn.closed or conn.status != psycopg2.extensions.STATUS_READY:
+            self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=True)
+            return
+
+        self._last_used[id(conn)] = monotonic()
+        self._pool.putconn(conn)
+
+    def _execute(self, command: str, args: tuple):
+        try:
+            conn = self._getconn()
+        except Exception as e:
+            return [type(e).__name__, str(e)]
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute(command, args)
+                return cur.fetchall()
+        except Exception as e:
+            return [type(e).__name__, str(e)]
+        finally:
+            self._putconn(conn)
+
+    def _execute_values(self, command: str, rows: list, template: str):
+        try:
+            conn = self._getconn()
+        except Exception as e:
+            return [type(e).__name__, str(e)]
+
+        try:
+            with conn.cursor() as cur:
+                return psycopg2.extras.execute_values(cur, command, rows, template, page_size=len(rows), fetch=True)
+        except Exception as e:
+            return [type(e).__name__, str(e)]
+        finally:
+            self._putconn(conn)
+
+    def _stream(self, command: str, consume, fetch_size: int, timeout: float):
+        try:
+            conn = self._getconn()
+        except Exception as e:
+            return [type(e).__name__, str(e)]
+
+        # named cursors live inside a transaction, rows then arrive fetch_size at a time instead of all at once
+        conn.autocommit = False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL statement_timeout = %s;", (int(timeout * 1000),))
+            with conn.cursor(name=f"cinotes_stream_{uuid4().hex}") as cur:
+                cur.itersize = fetch_size
+                cur.execute(command)
+                result = consume(cur)
+            # committed like any other statement, so side effects of selected functions are kept
+            conn.commit()
+            return result
+        except Exception as e:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+            return [type(e).__name__, str(e)]
+        finally:
+            self._putconn(conn)
+
+    async def execute(self, command: str, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._execute, command, args)
+
+    async def execute_values(self, command: str, rows: list, template: str = None):
+        started = perf_counter()
+        result = await asyncio.get_running_loop().run_in_executor(self._executor, self._execute_values, command, rows, template)
+        metrics.observe("db execute_values", perf_counter() - started, error=is_error(result))
+
+        return result
+
+    async def stream(self, command: str, consume, fetch_size: int, timeout: float):
+        # consume runs in the pool thread with the open cursor, the loop is never blocked by the rows
+        started = perf_counter()
+        result = await asyncio.get_running_loop().run_in_executor(self._executor, self._stream, command, consume, fetch_size, timeout)
+        metrics.observe("db stream", perf_counter() - started, error=is_error(result))
+
+        return result
+
+    async def open(self):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._open)
+
+    async def close(self):
+        if self.opened:
+            self._pool.closeall()
+            self._last_used.clear()
+            log("Database pool closed", LogMode.OK)
+
+
+db = DatabasePool()
+
+
+def is_error(result) -> bool:
+    return bool(result) and isinstance(result[0], str) and result != ["ProgrammingError", "no results to fetch"]
+
+
+async def cur_executor(command: str, *args):
+    started = perf_counter()
+    result = await db.execute(command, *args)
+    # a blank command from /sqlexecute still gets its sql error back instead of failing here
+    words = command.split(None, 1)
+    metrics.observe(f"db {words[0].lower() if words else 'unknown'}", perf_counter() - started, error=is_error(result))
+
+    return result
@@ -0,0 +1,100 @@
+import os
+import asyncio
+import traceback
+
+from time import monotonic
+from logger import log, LogMode
+
+
+ERROR_WINDOW = float(os.environ.get("cinotes_error_window", 300))
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class ErrorEntry:
+    __slots__ = ("count", "update", "traceback", "window_started")
+
+    def __init__(self, update: str, traceback: str):
+        self.count = 0
+        self.update = update
+        self.traceback = traceback
+        self.window_started = monotonic()
+
+
+class ErrorAggregator:
+    def __init__(self, window: float = ERROR_WINDOW):
+        self.window = window
+        self.entries = dict()
+        # coroutine function delivering a text to the owner, set by the bot
+        self.send = None
+
+        self._task = None
+
+    def fingerprint(self, e: BaseException) -> str:
+        frames = traceback.extract_tb(e.__traceback__)
+        if not frames:
+            return type(e).__name__
+
+        # the innermost frame of the bot itself names the failing call better than a library frame
+        own = [frame for frame in frames if frame.filename.startswith(PROJECT_DIR)]
+        frame = (own or frames)[-1]
+        return f"{type(e).__name__} at {os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+
+    async def report(self, update, e: BaseException):
+        fingerprint = self.fingerprint(e)
+        text = "".join(traceback.format_exception(type(e), e, e.__traceback__)).strip()
+
+        entry = self.entries.get(fingerprint)
+        if entry is not None:
+            # repeats inside the window only cost a counter, the digest carries the latest sample
+            entry.count += 1
+            entry.update = str(update)
+            entry.traceback = text
+            return
+
+        self.entries[fingerprint] = ErrorEntry(str(update), text)
+        await self.send(f"Перехвачена ошибка {fingerprint}\n\nUpdate: {update}\n\n{text}")
+
+    async def flush(self, force: bool = False):
+        now = monotonic()
+        for fingerprint, entry in list(self.entries.items()):
+            if not force and now - entry.window_started < self.window:
+                continue
+
+            # a quiet window forgets the error, so its next occurrence is reported at once again
+            if not entry.count:
+                del self.entries[fingerprint]
+                continue
+
+            count, elapsed = entry.count, now - entry.window_started
+            entry.count, entry.window_started = 0, now
+            try:
+                await self.send(
+                    f"Ошибка {fingerprint} повторилась {count} раз за {elapsed:.0f} секунд\n\n"
+                    f"Последний update: {entry.update}\n\n{entry.traceback}"
+                )
+            except Exception as e:
+                log(f"Get error when sending error digest: type: '{type(e).__name__}', text: '{e}'", LogMode.ERROR)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.window / 10)
+            await self.flush()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        await self.flush(force=True)
+
+
+error_digest = ErrorAggregator()
@@ -0,0 +1,78 @@
+import os
+import csv
+import gzip
+import json
+import tempfile
+
+from time import monotonic
+from database import db
+
+
+EXPORT_FORMAT = os.environ.get("cinotes_export_format", "csv")
+EXPORT_COMPRESS = os.environ.get("cinotes_export_compress") == "True"
+EXPORT_MAX_ROWS = int(os.environ.get("cinotes_export_max_rows", 100000))
+EXPORT_TIMEOUT = float(os.environ.get("cinotes_export_timeout", 60))
+EXPORT_FETCH_SIZE = int(os.environ.get("cinotes_export_fetch_size", 2000))
+
+EXPORT_FORMATS = ("csv", "jsonl")
+
+
+class ExportResult:
+    __slots__ = ("path", "filename", "rows", "truncated")
+
+    def __init__(self, path: str, filename: str, rows: int, truncated: bool):
+        self.path = path
+        self.filename = filename
+        self.rows = rows
+        self.truncated = truncated
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def write_rows(cursor, file, fmt: str, max_rows: int, deadline: float) -> tuple:
+    rows = 0
+    columns = None
+    writer = csv.writer(file) if fmt == "csv" else None
+
+    for row in cursor:
+        if rows >= max_rows or monotonic() > deadline:
+            return rows, True
+
+        # a named cursor knows its columns only after the first fetch
+        if columns is None:
+            columns = [column.name for column in cursor.description]
+            if writer is not None:
+                writer.writerow(columns)
+
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            file.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + "\n")
+        rows += 1
+
+    return rows, False
+
+
+async def export_query(query: str, fmt: str = EXPORT_FORMAT, compress: bool = EXPORT_COMPRESS,
+                       max_rows: int = EXPORT_MAX_ROWS, timeout: float = EXPORT_TIMEOUT):
+    filename = f"result.{fmt}" + (".gz" if compress else "")
+    # every request gets its own file, so concurrent exports never overwrite each other
+    fd, path = tempfile.mkstemp(prefix="cinotes-export-", suffix=f"-{filename}")
+    os.close(fd)
+
+    def consume(cursor):
+        deadline = monotonic() + timeout
+        opener = gzip.open if compress else open
+        with opener(path, "wt", encoding="utf-8", newline="") as file:
+            return write_rows(cursor, file, fmt, max_rows, deadline)
+
+    res = await db.stream(query, consume, EXPORT_FETCH_SIZE, timeout)
+    if isinstance(res[0], str):
+        os.remove(path)
+        return res
+
+    return ExportResult(path, filename, *res)
@@ -3,7 +3,7 @@ TEXTS = {
         "start_message": "Привіт, я бот персональних рекомендацій для проекту Cinotes. Тисни /help для отримання інструкцій",
         "user_not_in_db_error": "Виникла помилка всередині бота, відправ /start",
         "language_message": "Обрана мова: Українська",
-        "help_message": "/start - Активувати бота\n/help - Отримати інструкції (це повідомлення)\n/language - Обрати мову бота, доступні мови: Українська, Англійська\n/login - Додати твій акаунт до бота (без цього неможливо отримувати рекомендації)\n/logout - Видалити акаунт з бота (сам акаунт НЕ буде знищено)\n/getrec - Отримати рекомендацію - те, за чим ви сюди прийшли :)",
+        "help_message": "/start - Активувати бота\n/help - Отримати інструкції (це повідомлення)\n/language - Обрати мову бота, доступні мови: Українська, Англійська\n/login - Додати твій акаунт до бота (без цього неможливо отримувати рекомендації)\n/logout - Видалити акаунт з бота (сам акаунт НЕ буде знищено)\n/getrec - Отримати рекомендацію - те, за чим ви сюди прийшли :)\n/getrec N - Отримати одразу N різних рекомендацій\n/daily - Увімкнути або вимкнути щоденну рекомендацію (для преміум-акаунтів)",
         "already_logged_in": "Ти вже авторизований. Щоб зробити це знову, спочатку видали акаунт з бота за допомогою команди /logout",
         "press_button_to_login": "Просто натисни на кнопку внизу",
         "login_button_text": "Авторизуватися",
@@ -23,17 +23,28 @@ TEXTS = {
         "token_not_valid": "Термін дії токену авторизації сплинув або токен не валідний. Перевір, що акаунт підтверджено та авторизуйся знову за допомогою команди /login",
         "more_info_button_text": "Детальніше",
         "film_not_found": "Схоже, такого фільму наразі немає",
+        "getrec_count_error": "Кількість рекомендацій має бути числом від 1 до {max_count}, наприклад: /getrec 3",
         "full_info_text": "{name}\n\nКраїна: {country}\nДата виходу: {release_date}\nНаш рейтинг: {rating}\nIMDB рейтинг: {imdb_rating}\nЖанри: {genres}\nСтудія: {studio}\nРежисер: {director}",
-        "admin_message": "Доступні команди для адміністраторів:\n\n/stat - отримання статистики бота",
-        "stat_message": "Користувачів всього: {total_users}\n\nАкаунтів всього: {total_accounts}\nАдміністративних: {admin_accounts}\nПреміум: {premium_accounts}\n\nВсього рекомендацій: {total_recommendations}\nРекомендацій за сьогодні: {recommendations_today}",
+        "admin_message": "Доступні команди для адміністраторів:\n\n/stat - отримання статистики бота\n/metrics - затримки та помилки операцій бота\n/broadcast текст - розсилка повідомлення всім користувачам бота",
+        "stat_message": "Користувачів всього: {total_users}\n\nАкаунтів всього: {total_accounts}\nАдміністративних: {admin_accounts}\nПреміум: {premium_accounts}\n\nВсього рекомендацій: {total_recommendations}\nРекомендацій за сьогодні: {recommendations_today}\n\nРекомендацій по днях:\n{days}\n\nНайактивніші користувачі:\n{users}\n\nКеш каталогу: {catalog_cache_size} записів, влучань: {catalog_cache_hits}, промахів: {catalog_cache_misses}",
         "get_unknown_text_message": "Я не розумію тебе. Відправ /start або /help",
         "get_unknown_type_of_message": "Я приймаю лише текстові повідомлення. Для отримання інструкцій натисни /help",
+        "request_in_progress": "Зачекай, попередній запит ще обробляється",
+        "too_many_requests": "Забагато запитів, спробуй трохи пізніше",
+        "broadcast_usage": "Вкажи текст розсилки після команди: /broadcast текст",
+        "broadcast_in_progress": "Попередня розсилка ще не завершилась",
+        "broadcast_started": "Розсилку розпочато, я повідомлю, коли вона завершиться",
+        "broadcast_finished": "Розсилку завершено\nДоставлено: {sent}\nНе доставлено: {failed}",
+        "daily_premium_only": "Щоденна рекомендація доступна лише для преміум-акаунтів",
+        "daily_enabled": "Щоденну рекомендацію увімкнено, вона приходитиме раз на день. Щоб вимкнути, знову надішли /daily",
+        "daily_disabled": "Щоденну рекомендацію вимкнено",
+        "daily_push_message": "Твоя щоденна рекомендація:",
     },
     "en": {
         "start_message": "Hi, I'm a personal recommendation bot for the Cinotes project. Press /help for instructions",
         "user_not_in_db_error": "An error occurred inside the bot, send /start",
         "language_message": "Choosen language: English",
-        "help_message": "/start - Start bot\n/help - Get instructions (this message)\n/language - Choose bot language, available languages: Ukrainian, English\n/login - Add your account to the bot (without this it is impossible to receive recommendations)\n/logout - Delete the account from the bot (the account itself will NOT be destroyed)\n/getrec - Getting a recommendation - is what you came here for :)",
+        "help_message": "/start - Start bot\n/help - Get instructions (this message)\n/language - Choose bot language, available languages: Ukrainian, English\n/login - Add your account to the bot (without this it is impossible to receive recommendations)\n/logout - Delete the account from the bot (the account itself will NOT be destroyed)\n/getrec - Getting a recommendation - is what you came here for :)\n/getrec N - Get N different recommendations at once\n/daily - Turn the daily recommendation on or off (for premium accounts)",
         "already_logged_in": "You are already authorized. To do this again, first log out of the bot using the /logout command",
         "press_button_to_login": "Just click the button below",
         "login_button_text": "Log in",
@@ -53,10 +64,21 @@ TEXTS = {
         "token_not_valid": "The authorization token has expired or the token is invalid. Check that the account is verified and log in again using the /login command",
         "more_info_button_text": "More details",
         "film_not_found": "It seems that there is no such movie at the moment",
+        "getrec_count_error": "The number of recommendations must be a number from 1 to {max_count}, for example: /getrec 3",
         "full_info_text": "{name}\n\nCountry: {country}\nRelease date: {release_date}\nOur rating: {rating}\nIMDB rating: {imdb_rating}\nGenre: {genres}\nStudio: {studio}\nDirector: {director}",
-        "admin_message": "Available commands for administrators:\n\n/stat - getting bot statistics",
-        "stat_message": "Total users: {total_users}\n\nTotal accounts: {total_accounts}\nAdministrative: {admin_accounts}\nPremium: {premium_accounts}\n\nTotal recommendations: {total_recommendations}\nRecommendations for today: {recommendations_today}",
+        "admin_message": "Available commands for administrators:\n\n/stat - getting bot statistics\n/metrics - latencies and errors of bot operations\n/broadcast text - send a message to every user of the bot",
+        "stat_message": "Total users: {total_users}\n\nTotal accounts: {total_accounts}\nAdministrative: {admin_accounts}\nPremium: {premium_accounts}\n\nTotal recommendations: {total_recommendations}\nRecommendations for today: {recommendations_today}\n\nRecommendations by day:\n{days}\n\nMost active users:\n{users}\n\nCatalog cache: {catalog_cache_size} entries, hits: {catalog_cache_hits}, misses: {catalog_cache_misses}",
         "get_unknown_text_message": "I don't understand you. Send /start or /help",
         "get_unknown_type_of_message": "I only accept text messages. Click /help for instructions",
+        "request_in_progress": "Please wait, the previous request is still being processed",
+        "too_many_requests": "Too many requests, try again a bit later",
+        "broadcast_usage": "Put the broadcast text after the command: /broadcast text",
+        "broadcast_in_progress": "The previous broadcast has not finished yet",
+        "broadcast_started": "Broadcast started, I will let you know when it is finished",
+        "broadcast_finished": "Broadcast finished\nDelivered: {sent}\nNot delivered: {failed}",
+        "daily_premium_only": "The daily recommendation is available only for premium accounts",
+        "daily_enabled": "The daily recommendation is on, it will arrive once a day. Send /daily again to turn it off",
+        "daily_disabled": "The daily recommendation is off",
+        "daily_push_message": "Your daily recommendation:",
     }
 }
\ No newline at end of file
@@ -1,10 +1,20 @@
 import os
+import sys
+import queue
+import atexit
+import threading
 from enum import Enum
 from pathlib import Path
 from datetime import datetime
 from rgb_colorizer import colorize, RGBColor
 
 
+LOG_TO_FILE = os.environ.get("cinotes_log_to_file") == "True"
+LOG_DIR = Path(os.environ.get("cinotes_log_dir", "../cinotes-bot_logs"))
+LOG_LEVEL = os.environ.get("cinotes_log_level", "DEBUG").upper()
+LOG_FLUSH_INTERVAL = float(os.environ.get("cinotes_log_flush_interval", 1))
+
+
 class LogMode(Enum):
     OK = RGBColor(color_name="green")
     INFO = RGBColor(color_name="blue")
@@ -14,18 +24,103 @@ class LogMode(Enum):
     WARNING = RGBColor(color_name="violet")
 
 
-def log(text: str, mode: "LogMode | RGBColor") -> None:
-    log_time = colorize(str(datetime.now()), RGBColor(color_name="yellow"))
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+MODE_LEVELS = {
+    LogMode.DEFAULT: LEVELS["DEBUG"],
+    LogMode.TIME: LEVELS["DEBUG"],
+    LogMode.OK: LEVELS["INFO"],
+    LogMode.INFO: LEVELS["INFO"],
+    LogMode.WARNING: LEVELS["WARNING"],
+    LogMode.ERROR: LEVELS["ERROR"],
+}
+
+
+class LogWriter(threading.Thread):
+    def __init__(self, to_file: bool, log_dir: Path, flush_interval: float):
+        super().__init__(name="cinotes-logger", daemon=True)
+
+        self.to_file = to_file
+        self.log_dir = log_dir
+        self.flush_interval = flush_interval
+        self.queue = queue.SimpleQueue()
+
+        self._file = None
+        self._file_date = None
+
+    def _get_file(self, date):
+        if self._file_date != date:
+            if self._file is not None:
+                self._file.close()
+
+            self.log_dir.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.log_dir / f"log_{date}.txt", "a")
+            self._file_date = date
+
+        return self._file
+
+    def _format(self, log_time: datetime, text: str, color: RGBColor) -> str:
+        if self.to_file:
+            return f"{log_time} {text}\n"
+        return colorize(str(log_time), LogMode.TIME.value) + " " + colorize(text, color) + "\n"
 
-    color = mode if isinstance(mode, RGBColor) else mode.value
+    def _write(self, records: list):
+        for log_time, text, color in records:
+            line = self._format(log_time, text, color)
+            if self.to_file:
+                self._get_file(log_time.date()).write(line)
+            else:
+                sys.stdout.write(line)
 
-    log_text = log_time + " " + colorize(text, color)
+        if self.to_file:
+            self._file.flush()
+        else:
+            sys.stdout.flush()
 
-    if os.environ["cinotes_log_to_file"] == "True":
-        if not Path("../cinotes-bot_logs").exists():
-            Path("../cinotes-bot_logs").mkdir()
+    def run(self):
+        stopped = False
+        while not stopped:
+            try:
+                records = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
 
-        with open(f"../cinotes-bot_logs/log_{datetime.now().date()}.txt", "a") as f:
-            f.write(log_text + "\n")
+            # drain everything that piled up so one flush covers the whole batch
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in records:
+                stopped = True
+                records = [record for record in records if record is not None]
+
+            try:
+                self._write(records)
+            except Exception as e:
+                sys.stderr.write(f"Logger failed to write {len(records)} records: {type(e).__name__}: {e}\n")
+
+        if self._file is not None:
+            self._file.close()
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+
+_writer = LogWriter(LOG_TO_FILE, LOG_DIR, LOG_FLUSH_INTERVAL)
+_writer.start()
+atexit.register(_writer.stop)
+
+
+def log(text: str, mode: "LogMode | RGBColor") -> None:
+    if isinstance(mode, RGBColor):
+        level, color = LEVELS["INFO"], mode
     else:
-        print(log_text)
+        level, color = MODE_LEVELS[mode], mode.value
+
+    if level < LEVELS.get(LOG_LEVEL, LEVELS["DEBUG"]):
+        return
+
+    _writer.queue.put((datetime.now(), text, color))
@@ -0,0 +1,166 @@
+import os
+import re
+import sys
+
+from aiohttp import web
+from collections import deque
+from time import perf_counter
+from contextlib import contextmanager
+from logger import log, LogMode
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+
+METRICS_PORT = int(os.environ.get("cinotes_metrics_port", 0))
+METRICS_SAMPLES = int(os.environ.get("cinotes_metrics_samples", 2048))
+
+PERCENTILES = (50, 95, 99)
+
+
+class OperationStats:
+    __slots__ = ("count", "errors", "total_time", "samples")
+
+    def __init__(self, samples: int = METRICS_SAMPLES):
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        # latest latencies only, so percentiles follow current behaviour and memory stays fixed
+        self.samples = deque(maxlen=samples)
+
+    def observe(self, duration: float, error: bool = False):
+        self.count += 1
+        self.errors += error
+        self.total_time += duration
+        self.samples.append(duration)
+
+    def percentiles(self) -> dict:
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {p: 0.0 for p in PERCENTILES}
+        return {p: ordered[min(len(ordered) - 1, len(ordered) * p // 100)] for p in PERCENTILES}
+
+
+class Metrics:
+    def __init__(self):
+        self.operations = dict()
+        self.caches = dict()
+
+        self._runner = None
+
+    def observe(self, name: str, duration: float, error: bool = False):
+        stats = self.operations.get(name)
+        if stats is None:
+            stats = self.operations[name] = OperationStats()
+        stats.observe(duration, error)
+
+    @contextmanager
+    def timer(self, name: str):
+        started = perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(name, perf_counter() - started, error=True)
+            raise
+        else:
+            self.observe(name, perf_counter() - started)
+
+    def register_cache(self, name: str, cache):
+        self.caches[name] = cache
+
+    def render_text(self) -> str:
+        lines = []
+        for name, stats in sorted(self.operations.items()):
+            p = stats.percentiles()
+            lines.append(f"{name}: {stats.count} calls, {stats.errors} errors, p50 {p[50] * 1000:.1f} ms, p95 {p[95] * 1000:.1f} ms, p99 {p[99] * 1000:.1f} ms")
+
+        if self.caches:
+            lines.append("")
+        for name, cache in sorted(self.caches.items()):
+            lines.append(f"cache {name}: {len(cache)} entries, {cache.hits} hits, {cache.misses} misses, hit rate {cache.hit_rate:.1%}")
+
+        return "\n".join(lines) or "-"
+
+    def render_prometheus(self) -> str:
+        operations = [(name.replace("\\", "\\\\").replace('"', '\\"'), stats) for name, stats in sorted(self.operations.items())]
+        caches = sorted(self.caches.items())
+
+        # every metric family has to be written as one contiguous block
+        lines = ["# TYPE cinotes_operation_latency_seconds summary"]
+        for label, stats in operations:
+            for p, value in stats.percentiles().items():
+                lines.append(f'cinotes_operation_latency_seconds{{operation="{label}",quantile="{p / 100}"}} {value}')
+            lines.append(f'cinotes_operation_latency_seconds_sum{{operation="{label}"}} {stats.total_time}')
+            lines.append(f'cinotes_operation_latency_seconds_count{{operation="{label}"}} {stats.count}')
+
+        lines.append("# TYPE cinotes_operation_errors_total counter")
+        lines.extend(f'cinotes_operation_errors_total{{operation="{label}"}} {stats.errors}' for label, stats in operations)
+
+        lines.append("# TYPE cinotes_cache_hits_total counter")
+        lines.extend(f'cinotes_cache_hits_total{{cache="{name}"}} {cache.hits}' for name, cache in caches)
+        lines.append("# TYPE cinotes_cache_misses_total counter")
+        lines.extend(f'cinotes_cache_misses_total{{cache="{name}"}} {cache.misses}' for name, cache in caches)
+        lines.append("# TYPE cinotes_cache_entries gauge")
+        lines.extend(f'cinotes_cache_entries{{cache="{name}"}} {len(cache)}' for name, cache in caches)
+
+        return "\n".join(lines) + "\n"
+
+    async def start_server(self, port: int = METRICS_PORT, worker: int = 0):
+        if not port:
+            return
+        # worker processes keep separate counters, so each one serves them on its own port
+        port += worker
+
+        async def handle_metrics(request: web.Request):
+            return web.Response(text=self.render_prometheus(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, port=port).start()
+        log(f"Metrics endpoint listening on port {port}", LogMode.OK)
+
+    async def stop_server(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics = Metrics()
+
+
+def operation_name(kind: str, path: str) -> str:
+    # ids are folded so that every film or actor does not get its own series
+    return f"{kind} {re.sub(r'/[0-9]+', '/{id}', path)}"
+
+
+class InstrumentedBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        with metrics.timer(f"telegram {method}"):
+            return await super().request(method, data, files, **kwargs)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    def _start(self, data: dict):
+        handler = current_handler.get()
+        data["metrics_handler"] = handler.__name__ if handler is not None else "unknown"
+        data["metrics_started"] = perf_counter()
+
+    def _finish(self, data: dict):
+        if "metrics_started" in data:
+            # post-process runs in a finally block, so a handler failure is still the current exception
+            metrics.observe(f"handler {data['metrics_handler']}", perf_counter() - data["metrics_started"], error=sys.exc_info()[0] is not None)
+
+    async def on_process_message(self, message, data: dict):
+        self._start(data)
+
+    async def on_process_callback_query(self, callback, data: dict):
+        self._start(data)
+
+    async def on_post_process_message(self, message, results: list, data: dict):
+        self._finish(data)
+
+    async def on_post_process_callback_query(self, callback, results: list, data: dict):
+        self._finish(data)
@@ -0,0 +1,52 @@
+from logger import log, LogMode
+from stats import STATS_INDEXES
+from database import cur_executor
+
+
+# append only: a released migration is never edited, schema changes get a new version;
+# IF NOT EXISTS lets databases created before versioning adopt the history without errors
+MIGRATIONS = (
+    (1, "initial schema", (
+        "CREATE TABLE IF NOT EXISTS users(user_id BIGINT PRIMARY KEY NOT NULL, language TEXT NOT NULL);",
+        "CREATE TABLE IF NOT EXISTS accounts(user_id BIGINT PRIMARY KEY NOT NULL, user_type TEXT NOT NULL, jwt TEXT NOT NULL, expire_on BIGINT NOT NULL);",
+        "CREATE TABLE IF NOT EXISTS recommendation_system_usage(recommendation_id TEXT PRIMARY KEY NOT NULL, user_id BIGINT NOT NULL, on_date DATE NOT NULL, film_id BIGINT NOT NULL);",
+    )),
+    (2, "statistics indexes", STATS_INDEXES),
+    (3, "poster file ids", (
+        "CREATE TABLE IF NOT EXISTS poster_file_ids(film_id BIGINT PRIMARY KEY NOT NULL, file_id TEXT NOT NULL);",
+    )),
+    (4, "shared bot storage", (
+        "CREATE TABLE IF NOT EXISTS bot_storage(chat TEXT NOT NULL, \"user\" TEXT NOT NULL, state TEXT, "
+        "data JSONB NOT NULL DEFAULT '{}', bucket JSONB NOT NULL DEFAULT '{}', PRIMARY KEY (chat, \"user\"));",
+    )),
+    (5, "daily push opt-in", (
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS daily_push BOOLEAN NOT NULL DEFAULT FALSE;",
+        "CREATE INDEX IF NOT EXISTS users_daily_push_idx ON users(user_id) WHERE daily_push;",
+    )),
+)
+
+
+async def migrate():
+    res = await cur_executor(
+        "CREATE TABLE IF NOT EXISTS schema_migrations(version INTEGER PRIMARY KEY NOT NULL, name TEXT NOT NULL, applied_on TIMESTAMP NOT NULL DEFAULT now()); "
+        "SELECT COALESCE(MAX(version), 0) FROM schema_migrations;"
+    )
+    if isinstance(res[0], str):
+        return res
+
+    current = res[0][0]
+    for version, name, statements in MIGRATIONS:
+        if version <= current:
+            continue
+
+        # statements sent in one query run as a single transaction, so a failed migration leaves no trace
+        res = await cur_executor(
+            " ".join(statements) + " INSERT INTO schema_migrations(version, name) VALUES (%s, %s) RETURNING version;",
+            version, name
+        )
+        if isinstance(res[0], str):
+            return res
+
+        log(f"Applied database migration {version}: {name}", LogMode.OK)
+
+    return [(MIGRATIONS[-1][0],)]
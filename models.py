@@ -0,0 +1,82 @@
+import sys
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# orjson parses backend responses several times faster, the standard decoder is the fallback
+loads = orjson.loads if orjson is not None else json.loads
+
+
+def parse_film_id(url: str) -> int:
+    return int(url.split("/films/")[-1].split("/")[0])
+
+
+def intern(value):
+    # genre, country and studio names repeat across thousands of films, interning keeps one copy of each
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Genre:
+    __slots__ = ("id", "title")
+
+    def __init__(self, id: int, title: str):
+        self.id = id
+        self.title = title
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Genre":
+        return cls(data.get("id"), intern(data["title"]))
+
+
+class Actor:
+    __slots__ = ("id", "name")
+
+    def __init__(self, id: int, name: str):
+        self.id = id
+        self.name = name
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Actor":
+        return cls(data.get("id"), data.get("name"))
+
+
+class Film:
+    __slots__ = ("id", "title", "poster", "country", "release_date", "rating", "imdb_rating", "genres", "studio", "director")
+
+    def __init__(self, id: int, title: str, poster: str = None, country: str = None, release_date: str = None,
+                 rating: float = None, imdb_rating: float = None, genres: tuple = (), studio: str = None, director: str = None):
+        self.id = id
+        self.title = title
+        self.poster = poster
+        self.country = country
+        self.release_date = release_date
+        self.rating = rating
+        self.imdb_rating = imdb_rating
+        self.genres = genres
+        self.studio = studio
+        self.director = director
+
+    @property
+    def link(self) -> str:
+        return f"https://cintoes.link/films/{self.id}"
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Film":
+        # list items carry only the url, so the id is cut out of it here once instead of on every use
+        film_id = data["id"] if "id" in data else parse_film_id(data["url"])
+        return cls(
+            film_id,
+            data["title"],
+            data.get("poster_file"),
+            intern(data.get("country")),
+            data.get("release_date"),
+            data.get("rating"),
+            data.get("imdb_rating"),
+            tuple(intern(genre["title"]) for genre in data.get("genres", ())),
+            intern(data.get("studio")),
+            data.get("director")
+        )
@@ -0,0 +1,181 @@
+import os
+import heapq
+import asyncio
+import itertools
+
+from time import monotonic, perf_counter
+from cache import TTLCache
+from metrics import metrics, InstrumentedBot
+from logger import log, LogMode
+from contextlib import contextmanager
+from contextvars import ContextVar
+from throttling import TokenBucket
+from aiogram import exceptions as tg_exceptions
+
+
+# Telegram allows about 30 messages per second overall and about one per second in a chat
+SEND_RATE = float(os.environ.get("cinotes_send_rate", 25))
+SEND_BURST = float(os.environ.get("cinotes_send_burst", 10))
+CHAT_SEND_RATE = float(os.environ.get("cinotes_chat_send_rate", 1))
+CHAT_SEND_BURST = float(os.environ.get("cinotes_chat_send_burst", 3))
+SEND_MAX_CHATS = int(os.environ.get("cinotes_send_max_chats", 100000))
+SEND_RETRIES = int(os.environ.get("cinotes_send_retries", 3))
+
+# lower lanes go first whenever several sends wait for the same tokens
+USER_LANE = 0
+ALERT_LANE = 1
+BULK_LANE = 2
+
+LANE_NAMES = {USER_LANE: "user", ALERT_LANE: "alert", BULK_LANE: "bulk"}
+
+SCHEDULED_METHODS = {
+    "sendMessage", "sendPhoto", "sendDocument", "sendMediaGroup", "sendAnimation", "sendVideo", "sendAudio",
+    "sendVoice", "sendSticker", "copyMessage", "forwardMessage", "editMessageText", "editMessageCaption",
+    "editMessageMedia", "editMessageReplyMarkup"
+}
+
+current_lane = ContextVar("current_lane", default=USER_LANE)
+
+
+@contextmanager
+def send_lane(lane: int):
+    token = current_lane.set(lane)
+    try:
+        yield
+    finally:
+        current_lane.reset(token)
+
+
+class SendScheduler:
+    def __init__(self, rate: float = SEND_RATE, burst: float = SEND_BURST, chat_rate: float = CHAT_SEND_RATE,
+                 chat_burst: float = CHAT_SEND_BURST, max_chats: int = SEND_MAX_CHATS):
+        self.rate = rate
+        self.burst = burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+
+        self.bucket = TokenBucket(burst)
+        # an idle chat bucket is full again after chat_burst / chat_rate seconds, so it can be forgotten then
+        self.chats = TTLCache(max_chats, chat_burst / chat_rate)
+        # flood waits outlive the short-lived chat buckets, so they are kept apart from them
+        self.paused_until = dict()
+
+        self._waiting = []
+        self._order = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chats.peek(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_burst)
+        self.chats.set(chat_id, bucket)
+        return bucket
+
+    def _grant(self):
+        # releases every send that has tokens now and returns the time until the next one might, None if nothing waits
+        delay = None
+        deferred = []
+
+        while self._waiting:
+            wait = self.bucket.delay(self.rate, self.burst)
+            if wait > 0:
+                delay = wait if delay is None else min(delay, wait)
+                break
+
+            entry = heapq.heappop(self._waiting)
+            chat_id, future = entry[2], entry[3]
+            if future.done():
+                continue
+
+            paused_until = self.paused_until.get(chat_id)
+            if paused_until is not None:
+                wait = paused_until - monotonic()
+                if wait > 0:
+                    deferred.append(entry)
+                    delay = wait if delay is None else min(delay, wait)
+                    continue
+                del self.paused_until[chat_id]
+
+            chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+            if chat_bucket is not None:
+                wait = chat_bucket.delay(self.chat_rate, self.chat_burst)
+                if wait > 0:
+                    # a busy chat must not hold back sends to other chats
+                    deferred.append(entry)
+                    delay = wait if delay is None else min(delay, wait)
+                    continue
+                chat_bucket.consume(self.chat_rate, self.chat_burst)
+
+            self.bucket.consume(self.rate, self.burst)
+            future.set_result(None)
+
+        for entry in deferred:
+            heapq.heappush(self._waiting, entry)
+
+        return delay
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._grant()
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def acquire(self, chat_id, lane: int = USER_LANE):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (lane, next(self._order), chat_id, future))
+        self._wakeup.set()
+
+        # a cancelled wait leaves a done future behind, which the scheduler skips
+        await future
+
+    def pause(self, chat_id, seconds: float):
+        if chat_id is None:
+            # the debt is counted from now, a stale refill time would pay it off at once
+            self.bucket.updated = monotonic()
+            self.bucket.tokens = -seconds * self.rate
+        else:
+            self.paused_until[chat_id] = max(self.paused_until.get(chat_id, 0), monotonic() + seconds)
+        self._wakeup.set()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+scheduler = SendScheduler()
+
+
+class ScheduledBot(InstrumentedBot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        if method not in SCHEDULED_METHODS:
+            return await super().request(method, data, files, **kwargs)
+
+        chat_id = data.get("chat_id") if data else None
+        lane = current_lane.get()
+
+        for attempt in range(SEND_RETRIES + 1):
+            started = perf_counter()
+            await scheduler.acquire(chat_id, lane)
+            metrics.observe(f"send wait {LANE_NAMES[lane]}", perf_counter() - started)
+
+            try:
+                return await super().request(method, data, files, **kwargs)
+            except tg_exceptions.RetryAfter as e:
+                scheduler.pause(chat_id, e.timeout)
+                # uploaded files may already be read to the end, so only requests without them are sent again
+                if attempt == SEND_RETRIES or files:
+                    raise
+                log(f"Telegram asked to retry {method} to chat {chat_id} after {e.timeout} seconds", LogMode.WARNING)
@@ -0,0 +1,55 @@
+from logger import log, LogMode
+from database import cur_executor
+from aiogram import Bot, types, exceptions as tg_exceptions
+
+
+class PosterCache:
+    def __init__(self):
+        self.file_ids = dict()
+
+    async def load(self):
+        res = await cur_executor("SELECT film_id, file_id FROM poster_file_ids;")
+        if res and isinstance(res[0], str):
+            log(f"Get error when loading poster file ids: type: '{res[0]}', text: '{res[1]}'", LogMode.ERROR)
+            return
+
+        self.file_ids = dict(res)
+        log(f"Loaded {len(self.file_ids)} poster file ids", LogMode.INFO)
+
+    def get(self, film_id: int):
+        return self.file_ids.get(film_id)
+
+    async def remember(self, film_id: int, file_id: str):
+        if self.file_ids.get(film_id) == file_id:
+            return
+
+        self.file_ids[film_id] = file_id
+        res = await cur_executor(
+            "INSERT INTO poster_file_ids(film_id, file_id) VALUES (%s, %s) "
+            "ON CONFLICT (film_id) DO UPDATE SET file_id=EXCLUDED.file_id RETURNING film_id;",
+            film_id, file_id
+        )
+        if res and isinstance(res[0], str):
+            log(f"Get error when saving poster file id of film {film_id}: type: '{res[0]}', text: '{res[1]}'", LogMode.ERROR)
+
+    def forget(self, film_id: int):
+        self.file_ids.pop(film_id, None)
+
+
+posters = PosterCache()
+
+
+async def send_poster(bot: Bot, chat_id: int, film_id: int, poster_url: str, **kwargs) -> types.Message:
+    file_id = posters.get(film_id)
+    if file_id is not None:
+        try:
+            return await bot.send_photo(chat_id, file_id, **kwargs)
+        # only errors about the file itself mean the id went stale, per-chat errors would fail by url too
+        except (tg_exceptions.WrongFileIdentifier, tg_exceptions.WrongRemoteFileIdSpecified, tg_exceptions.TypeOfFileMismatch) as e:
+            log(f"Cached poster of film {film_id} was rejected, sending by url: '{e}'", LogMode.WARNING)
+            posters.forget(film_id)
+
+    message = await bot.send_photo(chat_id, poster_url, **kwargs)
+    await posters.remember(film_id, message.photo[-1].file_id)
+
+    return message
@@ -0,0 +1,136 @@
+import os
+import random
+import asyncio
+
+from time import monotonic
+from cache import TTLCache
+from logger import log, LogMode
+from database import cur_executor
+from backend import get_json
+from models import Film
+
+
+GENRE_POOL_SIZE = int(os.environ.get("cinotes_genre_pool_size", 200))
+GENRE_POOL_TTL = float(os.environ.get("cinotes_genre_pool_ttl", 900))
+SEEN_CACHE_SIZE = int(os.environ.get("cinotes_seen_cache_size", 10000))
+SEEN_CACHE_TTL = float(os.environ.get("cinotes_seen_cache_ttl", 3600))
+
+# random probes per requested film before falling back to a scan of unseen films
+PICK_ATTEMPTS = 8
+
+
+class GenrePool:
+    __slots__ = ("films", "refreshed_at")
+
+    def __init__(self, films: list):
+        self.films = [Film.from_json(film) for film in films]
+        self.refreshed_at = monotonic()
+
+    @property
+    def stale(self) -> bool:
+        return monotonic() - self.refreshed_at > GENRE_POOL_TTL
+
+
+class Recommender:
+    def __init__(self):
+        self.pools = dict()
+        self.seen = TTLCache(SEEN_CACHE_SIZE, SEEN_CACHE_TTL)
+
+        self._refreshing = dict()
+
+    async def _refresh(self, genre: str, jwt: str):
+        try:
+            data = await get_json("/films/", jwt, genre=genre, page_size=GENRE_POOL_SIZE)
+            self.pools[genre] = GenrePool(data["results"])
+        finally:
+            del self._refreshing[genre]
+
+    def _refresh_done(self, genre: str):
+        def callback(task: asyncio.Task):
+            if not task.cancelled() and task.exception() is not None:
+                e = task.exception()
+                log(f"Get error when refreshing pool of genre '{genre}': type: '{type(e).__name__}', text: '{e}'", LogMode.ERROR)
+        return callback
+
+    async def get_pool(self, genre: str, jwt: str) -> GenrePool:
+        pool = self.pools.get(genre)
+        if pool is not None and not pool.stale:
+            return pool
+
+        # concurrent requests for the same genre share one download
+        task = self._refreshing.get(genre)
+        if task is None:
+            task = self._refreshing[genre] = asyncio.create_task(self._refresh(genre, jwt))
+            task.add_done_callback(self._refresh_done(genre))
+
+        # stale pools keep serving while the fresh copy is downloaded in the background
+        if pool is not None:
+            return pool
+
+        await asyncio.shield(task)
+        return self.pools[genre]
+
+    async def get_seen(self, user_id: int) -> set:
+        seen = self.seen.get(user_id)
+        if seen is not None:
+            return seen
+
+        res = await cur_executor("SELECT DISTINCT film_id FROM recommendation_system_usage WHERE user_id=%s;", user_id)
+        if res and isinstance(res[0], str):
+            log(f"Get error when loading recommended films of user {user_id}: type: '{res[0]}', text: '{res[1]}'", LogMode.ERROR)
+            return set()
+
+        seen = {row[0] for row in res}
+        self.seen.set(user_id, seen)
+        return seen
+
+    async def get_seen_many(self, user_ids: list) -> dict:
+        seen = {user_id: self.seen.get(user_id) for user_id in user_ids}
+        missing = [user_id for user_id, films in seen.items() if films is None]
+        if not missing:
+            return seen
+
+        # one query for the whole batch instead of one per user
+        res = await cur_executor("SELECT user_id, film_id FROM recommendation_system_usage WHERE user_id = ANY(%s);", missing)
+        if res and isinstance(res[0], str):
+            log(f"Get error when loading recommended films of {len(missing)} users: type: '{res[0]}', text: '{res[1]}'", LogMode.ERROR)
+            return {user_id: films if films is not None else set() for user_id, films in seen.items()}
+
+        for user_id in missing:
+            seen[user_id] = set()
+        for user_id, film_id in res:
+            seen[user_id].add(film_id)
+        for user_id in missing:
+            self.seen.set(user_id, seen[user_id])
+
+        return seen
+
+    def mark_seen(self, user_id: int, film_id: int):
+        seen = self.seen.peek(user_id)
+        if seen is not None:
+            seen.add(film_id)
+
+    def pick(self, pool: GenrePool, seen: set, count: int = 1) -> list:
+        films = pool.films
+        if not films:
+            return []
+
+        count = min(count, len(films))
+        picked = dict()
+
+        for _ in range(count * PICK_ATTEMPTS):
+            film = films[random.randrange(len(films))]
+            if film.id not in seen and film.id not in picked:
+                picked[film.id] = film
+                if len(picked) == count:
+                    return list(picked.values())
+
+        # the user has seen most of the pool, so pick from what is left and repeat films only if nothing is
+        unseen = [film for film in films if film.id not in seen and film.id not in picked]
+        rest = unseen or [film for film in films if film.id not in picked]
+        picked.update((film.id, film) for film in random.sample(rest, min(count - len(picked), len(rest))))
+
+        return list(picked.values())
+
+
+recommender = Recommender()
@@ -0,0 +1,154 @@
+import os
+import asyncio
+
+from time import monotonic
+from cache import TTLCache
+from database import cur_executor
+
+
+SESSION_CACHE_SIZE = int(os.environ.get("cinotes_session_cache_size", 10000))
+SESSION_CACHE_TTL = float(os.environ.get("cinotes_session_cache_ttl", 600))
+ROLES_TTL = float(os.environ.get("cinotes_roles_ttl", 300))
+WARM_SESSIONS_DAYS = int(os.environ.get("cinotes_warm_sessions_days", 7))
+WARM_SESSIONS_LIMIT = int(os.environ.get("cinotes_warm_sessions_limit", 1000))
+
+SESSION_QUERY = (
+    "SELECT u.language, a.user_type, a.jwt, a.expire_on FROM (SELECT %s::BIGINT AS user_id) q "
+    "LEFT JOIN users u ON u.user_id = q.user_id LEFT JOIN accounts a ON a.user_id = q.user_id;"
+)
+
+# users who asked for recommendations lately, found through the on_date index
+WARM_SESSIONS_QUERY = (
+    "SELECT u.user_id, u.language, a.user_type, a.jwt, a.expire_on FROM "
+    "(SELECT DISTINCT user_id FROM recommendation_system_usage WHERE on_date >= CURRENT_DATE - %s LIMIT %s) r "
+    "JOIN users u ON u.user_id = r.user_id LEFT JOIN accounts a ON a.user_id = r.user_id;"
+)
+
+
+class SessionLoadError(Exception):
+    def __init__(self, type: str, text: str):
+        super().__init__(type, text)
+        self.type = type
+        self.text = text
+
+
+class UserSession:
+    __slots__ = ("user_id", "language", "user_type", "jwt", "expire_on")
+
+    def __init__(self, user_id: int, language: str = None, user_type: str = None, jwt: str = None, expire_on: int = None):
+        self.user_id = user_id
+        self.language = language
+        self.user_type = user_type
+        self.jwt = jwt
+        self.expire_on = expire_on
+
+    @property
+    def exists(self) -> bool:
+        return self.language is not None
+
+    @property
+    def logged_in(self) -> bool:
+        return self.user_type is not None
+
+
+class SessionCache:
+    def __init__(self, maxsize: int = SESSION_CACHE_SIZE, ttl: float = SESSION_CACHE_TTL):
+        self.cache = TTLCache(maxsize, ttl)
+        # set by the shared state backend to tell other workers about writes
+        self.on_change = None
+
+    async def _load(self, user_id: int) -> UserSession:
+        res = await cur_executor(SESSION_QUERY, user_id)
+        if isinstance(res[0], str):
+            raise SessionLoadError(res[0], res[1])
+        return UserSession(user_id, *res[0])
+
+    async def get(self, user_id: int) -> UserSession:
+        return await self.cache.get_or_fetch(user_id, lambda: self._load(user_id))
+
+    async def warm(self, days: int = WARM_SESSIONS_DAYS, limit: int = WARM_SESSIONS_LIMIT) -> int:
+        res = await cur_executor(WARM_SESSIONS_QUERY, days, limit)
+        if res and isinstance(res[0], str):
+            raise SessionLoadError(res[0], res[1])
+
+        for user_id, *row in res:
+            # sessions loaded by handlers in the meantime are newer than this snapshot
+            if self.cache.peek(user_id) is None:
+                self.cache.set(user_id, UserSession(user_id, *row))
+        return len(res)
+
+    def _changed(self, user_id: int):
+        if self.on_change is not None:
+            self.on_change(user_id)
+
+    # write-through helpers, called after the matching statement succeeded;
+    # sessions that are not cached are loaded fresh on the next get
+
+    def set_language(self, user_id: int, language: str):
+        session = self.cache.peek(user_id)
+        if session is not None:
+            session.language = language
+        self._changed(user_id)
+
+    def set_account(self, user_id: int, user_type: str, jwt: str, expire_on: int):
+        session = self.cache.peek(user_id)
+        if session is not None:
+            session.user_type = user_type
+            session.jwt = jwt
+            session.expire_on = expire_on
+        self._changed(user_id)
+
+    def remove_account(self, user_id: int):
+        session = self.cache.peek(user_id)
+        if session is not None:
+            session.user_type = session.jwt = session.expire_on = None
+        self._changed(user_id)
+
+    def invalidate(self, user_id: int):
+        self.cache.pop(user_id)
+
+
+class RoleMap:
+    def __init__(self, ttl: float = ROLES_TTL):
+        self.ttl = ttl
+
+        self._admins = set()
+        self._loaded_at = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def fresh(self) -> bool:
+        return self._loaded_at is not None and monotonic() - self._loaded_at < self.ttl
+
+    async def reload(self):
+        async with self._lock:
+            if self.fresh:
+                return
+
+            res = await cur_executor("SELECT user_id FROM accounts WHERE user_type='admin';")
+            if res and isinstance(res[0], str):
+                raise SessionLoadError(res[0], res[1])
+
+            self._admins = {row[0] for row in res}
+            self._loaded_at = monotonic()
+
+    async def is_admin(self, user_id: int) -> bool:
+        if not self.fresh:
+            await self.reload()
+        return user_id in self._admins
+
+    def expire(self):
+        self._loaded_at = None
+
+    def set_role(self, user_id: int, user_type: str):
+        if user_type == "admin":
+            self._admins.add(user_id)
+        else:
+            self._admins.discard(user_id)
+
+    def remove(self, user_id: int):
+        self._admins.discard(user_id)
+
+
+sessions = SessionCache()
+roles = RoleMap()
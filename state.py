@@ -0,0 +1,203 @@
+import os
+import typing
+import asyncio
+import psycopg2
+
+from uuid import uuid4
+from logger import log, LogMode
+from sessions import sessions, roles
+from psycopg2.extras import Json
+from database import cur_executor, connection_params
+from aiogram.dispatcher.storage import BaseStorage
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+
+STATE_BACKEND = os.environ.get("cinotes_state_backend", "memory")
+STATE_CHANNEL = "cinotes_state"
+STATE_RECONNECT_DELAY = float(os.environ.get("cinotes_state_reconnect_delay", 5))
+
+WORKER_ID = uuid4().hex
+
+
+class StateError(Exception):
+    pass
+
+
+def checked(res):
+    if res and isinstance(res[0], str) and res != ["ProgrammingError", "no results to fetch"]:
+        raise StateError(res[0], res[1])
+    return res
+
+
+class PostgresStorage(BaseStorage):
+    async def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    async def _get(self, column: str, chat, user):
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        res = checked(await cur_executor(f"SELECT {column} FROM bot_storage WHERE chat=%s AND \"user\"=%s;", chat, user))
+        return res[0][0] if res else None
+
+    async def _set(self, column: str, value, chat, user, merge: bool = False):
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        update = f"bot_storage.{column} || EXCLUDED.{column}" if merge else f"EXCLUDED.{column}"
+        checked(await cur_executor(
+            f"INSERT INTO bot_storage(chat, \"user\", {column}) VALUES (%s, %s, %s) "
+            f"ON CONFLICT (chat, \"user\") DO UPDATE SET {column}={update};",
+            chat, user, value
+        ))
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        state = await self._get("state", chat, user)
+        return self.resolve_state(default) if state is None else state
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        return await self._get("data", chat, user) or default or {}
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        await self._set("state", self.resolve_state(state), chat, user)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        await self._set("data", Json(data or {}), chat, user)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None,
+                          **kwargs):
+        await self._set("data", Json(dict(data or {}, **kwargs)), chat, user, merge=True)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        return await self._get("bucket", chat, user) or default or {}
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        await self._set("bucket", Json(bucket or {}), chat, user)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None,
+                            **kwargs):
+        await self._set("bucket", Json(dict(bucket or {}, **kwargs)), chat, user, merge=True)
+
+
+class MemoryState:
+    def __init__(self):
+        self.storage = MemoryStorage()
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class PostgresState:
+    def __init__(self):
+        self.storage = PostgresStorage()
+
+        self._conn = None
+        self._tasks = set()
+        self._reconnecting = None
+        self._stopped = False
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _listen(self):
+        self._conn = psycopg2.connect(**connection_params())
+        self._conn.autocommit = True
+        self._conn.cursor().execute(f"LISTEN {STATE_CHANNEL};")
+        asyncio.get_running_loop().add_reader(self._conn.fileno(), self._on_notify)
+
+    def _unlisten(self):
+        if self._conn is not None:
+            asyncio.get_running_loop().remove_reader(self._conn.fileno())
+            self._conn.close()
+            self._conn = None
+
+    async def _reconnect(self):
+        # a stopped worker must not open the listener again behind the back of stop()
+        while self._conn is None and not self._stopped:
+            await asyncio.sleep(STATE_RECONNECT_DELAY)
+            if self._stopped:
+                return
+            try:
+                self._listen()
+            except psycopg2.Error as e:
+                log(f"Get error when reconnecting state listener: type: '{type(e).__name__}', text: '{e}'", LogMode.ERROR)
+                continue
+
+            # notifications may have been missed while disconnected
+            sessions.cache.clear()
+            roles.expire()
+            log("State listener reconnected", LogMode.OK)
+
+    def _on_notify(self):
+        try:
+            self._conn.poll()
+        except psycopg2.Error as e:
+            log(f"State listener lost connection: type: '{type(e).__name__}', text: '{e}'", LogMode.ERROR)
+            self._unlisten()
+            self._reconnecting = asyncio.create_task(self._reconnect())
+            return
+
+        while self._conn.notifies:
+            origin, user_id = self._conn.notifies.pop(0).payload.split(":")
+            if origin != WORKER_ID:
+                sessions.invalidate(int(user_id))
+                roles.expire()
+
+    def publish_user_change(self, user_id: int):
+        self._spawn(cur_executor("SELECT pg_notify(%s, %s);", STATE_CHANNEL, f"{WORKER_ID}:{user_id}"))
+
+    async def start(self):
+        self._stopped = False
+        self._listen()
+        sessions.on_change = self.publish_user_change
+        log(f"Shared state listener started for worker {WORKER_ID}", LogMode.OK)
+
+    async def stop(self):
+        self._stopped = True
+        sessions.on_change = None
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+            try:
+                await self._reconnecting
+            except asyncio.CancelledError:
+                pass
+            self._reconnecting = None
+        self._unlisten()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def create_state():
+    if STATE_BACKEND == "postgres":
+        return PostgresState()
+    return MemoryState()
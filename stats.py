@@ -0,0 +1,64 @@
+import os
+
+from cache import TTLCache
+from datetime import datetime
+from database import cur_executor
+
+
+STATS_CACHE_TTL = float(os.environ.get("cinotes_stats_cache_ttl", 30))
+STATS_DAYS = int(os.environ.get("cinotes_stats_days", 7))
+STATS_TOP_USERS = int(os.environ.get("cinotes_stats_top_users", 5))
+
+STATS_QUERY = """
+WITH a AS (
+    SELECT COUNT(*) AS total,
+           COUNT(*) FILTER (WHERE user_type='admin') AS admins,
+           COUNT(*) FILTER (WHERE user_type='premium') AS premium
+    FROM accounts
+), r AS (
+    SELECT COUNT(*) AS total, COUNT(*) FILTER (WHERE on_date=%s) AS today FROM recommendation_system_usage
+)
+SELECT
+    (SELECT COUNT(*) FROM users), a.total, a.admins, a.premium, r.total, r.today,
+    (SELECT COALESCE(json_agg(json_build_array(d.on_date, d.count) ORDER BY d.on_date DESC), '[]')
+     FROM (SELECT on_date, COUNT(*) AS count FROM recommendation_system_usage
+           WHERE on_date > %s::date - %s GROUP BY on_date) d),
+    (SELECT COALESCE(json_agg(json_build_array(t.user_id, t.count) ORDER BY t.count DESC), '[]')
+     FROM (SELECT user_id, COUNT(*) AS count FROM recommendation_system_usage
+           GROUP BY user_id ORDER BY count DESC LIMIT %s) t)
+FROM a, r;
+"""
+
+STATS_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS recommendation_system_usage_on_date_idx ON recommendation_system_usage(on_date);",
+    "CREATE INDEX IF NOT EXISTS recommendation_system_usage_user_id_idx ON recommendation_system_usage(user_id);",
+)
+
+stats_cache = TTLCache(1, STATS_CACHE_TTL)
+
+
+async def get_stats():
+    stats = stats_cache.peek("stats")
+    if stats is not None:
+        return stats
+
+    today = datetime.now().date()
+    res = await cur_executor(STATS_QUERY, today, today, STATS_DAYS, STATS_TOP_USERS)
+    if isinstance(res[0], str):
+        return res
+
+    row = res[0]
+    stats = {
+        "total_users": row[0],
+        "total_accounts": row[1],
+        "admin_accounts": row[2],
+        "premium_accounts": row[3],
+        "total_recommendations": row[4],
+        "recommendations_today": row[5],
+        "recommendations_by_day": row[6],
+        "top_users": row[7]
+    }
+
+    if STATS_CACHE_TTL > 0:
+        stats_cache.set("stats", stats)
+    return stats
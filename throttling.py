@@ -0,0 +1,127 @@
+import os
+
+from time import monotonic
+from cache import TTLCache
+from languages import TEXTS
+from sessions import sessions
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+
+THROTTLE_RATE = float(os.environ.get("cinotes_throttle_rate", 0.5))
+THROTTLE_BURST = float(os.environ.get("cinotes_throttle_burst", 3))
+THROTTLE_MAX_USERS = int(os.environ.get("cinotes_throttle_max_users", 100000))
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float):
+        self.tokens = tokens
+        self.updated = monotonic()
+
+    def _refill(self, rate: float, burst: float):
+        now = monotonic()
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def delay(self, rate: float, burst: float) -> float:
+        self._refill(rate, burst)
+        return max(0.0, (1 - self.tokens) / rate)
+
+    def consume(self, rate: float, burst: float) -> bool:
+        self._refill(rate, burst)
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, handlers: set, rate: float = THROTTLE_RATE, burst: float = THROTTLE_BURST, max_users: int = THROTTLE_MAX_USERS):
+        super().__init__()
+
+        self.handlers = handlers
+        self.rate = rate
+        self.burst = burst
+
+        # an idle bucket refills completely after burst / rate seconds, so it can be forgotten then
+        self.buckets = TTLCache(max_users, burst / rate)
+        self.in_flight = set()
+        # chats already told they are throttled, so a flood of messages gets one reply instead of one each
+        self.warned = TTLCache(max_users, burst / rate)
+
+    def _request_key(self, chat_id: int, request: str):
+        handler = current_handler.get()
+        if handler is None or handler.__name__ not in self.handlers:
+            return None
+        return handler.__name__, chat_id, request
+
+    def _allowed(self, user_id: int) -> bool:
+        bucket = self.buckets.peek(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.burst)
+        self.buckets.set(user_id, bucket)
+        return bucket.consume(self.rate, self.burst)
+
+    def _acquire(self, key, user_id: int, data: dict):
+        # identical requests that are already running are dropped, the running one answers for them
+        if key in self.in_flight:
+            return "request_in_progress"
+        if not self._allowed(user_id):
+            return "too_many_requests"
+
+        self.in_flight.add(key)
+        data["throttling_key"] = key
+        return None
+
+    def _lang(self, chat_id: int) -> str:
+        session = sessions.cache.peek(chat_id)
+        return session.language if session is not None and session.exists else "en"
+
+    def _warn_once(self, chat_id: int, reason: str) -> bool:
+        if (chat_id, reason) in self.warned:
+            return False
+        self.warned.set((chat_id, reason), True)
+        return True
+
+    def _release(self, data: dict):
+        key = data.get("throttling_key")
+        if key is not None:
+            self.in_flight.discard(key)
+            self.warned.pop((key[1], "request_in_progress"))
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        command = message.get_command(pure=True)
+        # arguments are part of the request, /getrec 3 is not the same as a running /getrec
+        key = self._request_key(message.chat.id, f"{command} {message.get_args()}" if command else message.text)
+        if key is None:
+            return
+
+        reason = self._acquire(key, message.chat.id, data)
+        if reason:
+            if self._warn_once(message.chat.id, reason):
+                await message.answer(TEXTS[self._lang(message.chat.id)][reason])
+            raise CancelHandler()
+
+    async def on_process_callback_query(self, callback: types.CallbackQuery, data: dict):
+        if callback.message is None:
+            return
+
+        key = self._request_key(callback.message.chat.id, callback.data)
+        if key is None:
+            return
+
+        reason = self._acquire(key, callback.message.chat.id, data)
+        if reason:
+            await callback.answer(TEXTS[self._lang(callback.message.chat.id)][reason])
+            raise CancelHandler()
+
+    async def on_post_process_message(self, message: types.Message, results: list, data: dict):
+        self._release(data)
+
+    async def on_post_process_callback_query(self, callback: types.CallbackQuery, results: list, data: dict):
+        self._release(data)
@@ -0,0 +1,94 @@
+import os
+import random
+import asyncio
+
+from time import time
+from datetime import datetime
+from database import db
+from logger import log, LogMode
+
+
+USAGE_BATCH_SIZE = int(os.environ.get("cinotes_usage_batch_size", 100))
+USAGE_FLUSH_INTERVAL = float(os.environ.get("cinotes_usage_flush_interval", 2))
+USAGE_MAX_PENDING = int(os.environ.get("cinotes_usage_max_pending", 10000))
+
+INSERT_USAGE = (
+    "INSERT INTO recommendation_system_usage(recommendation_id, user_id, on_date, film_id) VALUES %s "
+    "ON CONFLICT (recommendation_id) DO NOTHING RETURNING recommendation_id;"
+)
+
+
+def gen_recommendation_id() -> str:
+    # millisecond timestamp first so ids are time-ordered, random tail against collisions within a millisecond
+    return f"{int(time() * 1000):011x}{random.getrandbits(40):010x}"
+
+
+class UsageWriter:
+    def __init__(self, batch_size: int = USAGE_BATCH_SIZE, flush_interval: float = USAGE_FLUSH_INTERVAL, max_pending: int = USAGE_MAX_PENDING):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._pending = []
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+
+    def record(self, user_id: int, film_id: int):
+        self.record_many([(user_id, film_id)])
+
+    def record_many(self, usages: list):
+        on_date = datetime.now().date()
+        self._pending.extend((gen_recommendation_id(), user_id, on_date, film_id) for user_id, film_id in usages)
+
+        if len(self._pending) > self.max_pending:
+            dropped = len(self._pending) - self.max_pending
+            del self._pending[:dropped]
+            log(f"Usage writer buffer is full, dropped {dropped} oldest rows", LogMode.ERROR)
+
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._pending:
+                rows, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+
+                res = await db.execute_values(INSERT_USAGE, rows)
+                if res and isinstance(res[0], str):
+                    log(f"Get error when flushing {len(rows)} usage rows: type: '{res[0]}', text: '{res[1]}'", LogMode.ERROR)
+                    self._pending[:0] = rows
+                    return
+
+                # rows that lost an id collision are queued again with fresh ids
+                written = {row[0] for row in res}
+                collided = [(gen_recommendation_id(), *row[1:]) for row in rows if row[0] not in written]
+                self._pending.extend(collided)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        await self.flush()
+
+
+usage_writer = UsageWriter()
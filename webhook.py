@@ -0,0 +1,115 @@
+import os
+import hmac
+import asyncio
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+from logger import log, LogMode
+
+
+WEBHOOK_HOST = os.environ.get("cinotes_webhook_host", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("cinotes_webhook_port", 8080))
+WEBHOOK_PATH = os.environ.get("cinotes_webhook_path", "/webhook")
+WEBHOOK_URL = os.environ.get("cinotes_webhook_url")
+WEBHOOK_SECRET = os.environ.get("cinotes_webhook_secret")
+WEBHOOK_WORKERS = int(os.environ.get("cinotes_webhook_workers", 16))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("cinotes_webhook_queue_size", 1000))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class UpdateQueue:
+    def __init__(self, dp: Dispatcher, workers: int = WEBHOOK_WORKERS, maxsize: int = WEBHOOK_QUEUE_SIZE):
+        self.dp = dp
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize)
+
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.process_update(update)
+            except Exception as e:
+                log(f"Get error when processing update {update.update_id}: type: '{type(e).__name__}', text: '{e}'", LogMode.ERROR)
+            finally:
+                self.queue.task_done()
+
+    def put(self, update: types.Update):
+        self.queue.put_nowait(update)
+
+    def start(self):
+        # handlers rely on the current bot and dispatcher, worker tasks copy them from this context
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        await self.queue.join()
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+def make_webhook_app(dp: Dispatcher, on_startup=None, on_shutdown=None, secret: str = WEBHOOK_SECRET) -> web.Application:
+    updates = UpdateQueue(dp)
+
+    async def handle_update(request: web.Request):
+        if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            log(f"Rejected webhook request from {request.remote}: wrong secret token", LogMode.WARNING)
+            return web.Response(status=401)
+
+        try:
+            update = types.Update.to_object(await request.json())
+        except (ValueError, TypeError):
+            # not json at all, or json that is not an update object
+            return web.Response(status=400)
+
+        try:
+            updates.put(update)
+        except asyncio.QueueFull:
+            # Telegram redelivers the update later, which is the backpressure we want
+            log(f"Webhook queue is full, update {update.update_id} rejected", LogMode.WARNING)
+            return web.Response(status=503)
+
+        return web.Response()
+
+    async def app_startup(app: web.Application):
+        if on_startup is not None:
+            await on_startup(dp)
+
+        updates.start()
+
+        if WEBHOOK_URL:
+            await dp.bot.set_webhook(WEBHOOK_URL, secret_token=secret, max_connections=min(WEBHOOK_WORKERS, 100))
+            log(f"Webhook set to {WEBHOOK_URL}", LogMode.OK)
+
+    async def app_shutdown(app: web.Application):
+        await updates.stop()
+
+        if on_shutdown is not None:
+            await on_shutdown(dp)
+
+        session = await dp.bot.get_session()
+        await session.close()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    app.on_startup.append(app_startup)
+    app.on_shutdown.append(app_shutdown)
+
+    return app
+
+
+def start_webhook(dp: Dispatcher, on_startup=None, on_shutdown=None):
+    # without the secret token anyone who finds the endpoint could post updates as any user
+    if not WEBHOOK_SECRET:
+        log("Webhook mode needs cinotes_webhook_secret, refusing to start", LogMode.ERROR)
+        raise SystemExit(1)
+
+    log(f"Listening for webhook updates on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}", LogMode.INFO)
+    web.run_app(make_webhook_app(dp, on_startup, on_shutdown), host=WEBHOOK_HOST, port=WEBHOOK_PORT, print=None)
@@ -0,0 +1,187 @@
+import os
+import signal
+import asyncio
+import aiohttp
+import multiprocessing
+
+from logger import log, LogMode
+
+
+WORKERS = int(os.environ.get("cinotes_workers", os.cpu_count() or 1))
+WORKER_CONCURRENCY = int(os.environ.get("cinotes_worker_concurrency", 32))
+POLLING_TIMEOUT = int(os.environ.get("cinotes_polling_timeout", 20))
+POLLING_RETRY_DELAY = float(os.environ.get("cinotes_polling_retry_delay", 1))
+POLLING_MAX_RETRY_DELAY = float(os.environ.get("cinotes_polling_max_retry_delay", 30))
+WORKER_MAX_RESTARTS = int(os.environ.get("cinotes_worker_max_restarts", 10))
+
+
+def partition_key(update) -> int:
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+
+    for event in (update.message, update.edited_message, update.channel_post, update.edited_channel_post, update.my_chat_member, update.chat_member):
+        if event:
+            return event.chat.id
+
+    return update.update_id
+
+
+class OrderedProcessor:
+    def __init__(self, dp, concurrency: int = WORKER_CONCURRENCY):
+        self.dp = dp
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+        # last scheduled task per chat, so updates of one chat run strictly in order
+        self._tails = dict()
+
+    async def _process(self, previous, update):
+        if previous is not None:
+            await asyncio.wait({previous})
+
+        async with self.semaphore:
+            try:
+                await self.dp.process_update(update)
+            except Exception as e:
+                log(f"Get error when processing update {update.update_id}: type: '{type(e).__name__}', text: '{e}'", LogMode.ERROR)
+
+    def submit(self, update):
+        key = partition_key(update)
+        task = asyncio.create_task(self._process(self._tails.get(key), update))
+        self._tails[key] = task
+
+        def forget(done):
+            if self._tails.get(key) is done:
+                del self._tails[key]
+
+        task.add_done_callback(forget)
+
+    async def join(self):
+        while self._tails:
+            await asyncio.wait(set(self._tails.values()))
+
+
+async def run_worker(index: int, updates: multiprocessing.Queue, ready):
+    from aiogram import Bot, Dispatcher, types
+    from bot import dp, startup, shutdown
+
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+
+    await startup(dp, primary=index == 0, worker=index)
+    log(f"Worker {index} started", LogMode.OK)
+    ready.set()
+
+    processor = OrderedProcessor(dp)
+    loop = asyncio.get_running_loop()
+
+    while True:
+        data = await loop.run_in_executor(None, updates.get)
+        if data is None:
+            break
+        processor.submit(types.Update.to_object(data))
+
+    await processor.join()
+    await shutdown(dp)
+
+    session = await dp.bot.get_session()
+    await session.close()
+
+
+def worker_main(index: int, updates: multiprocessing.Queue, ready):
+    # the launcher handles Ctrl+C and stops workers through their queues
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_worker(index, updates, ready))
+
+
+class WorkerSet:
+    def __init__(self, count: int = WORKERS):
+        self.context = multiprocessing.get_context("spawn")
+        self.queues = [self.context.Queue() for _ in range(count)]
+        self.ready = [self.context.Event() for _ in range(count)]
+        self.processes = [None] * count
+        self.restarts = 0
+
+    def start(self, index: int):
+        self.ready[index].clear()
+        process = self.context.Process(target=worker_main, args=(index, self.queues[index], self.ready[index]), name=f"cinotes-worker-{index}")
+        process.start()
+        self.processes[index] = process
+
+    def restart_dead(self):
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+
+            self.restarts += 1
+            if self.restarts > WORKER_MAX_RESTARTS:
+                raise RuntimeError(f"workers died {self.restarts} times, last was worker {index} with exit code {process.exitcode}")
+
+            # the queue outlives the process, so updates put for the dead worker are read by its replacement
+            log(f"Worker {index} died with exit code {process.exitcode}, restarting", LogMode.ERROR)
+            self.start(index)
+
+    def put(self, update):
+        self.queues[partition_key(update) % len(self.queues)].put(update.to_python())
+
+    def stop(self):
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            if process is not None:
+                process.join()
+
+
+async def poll(workers: WorkerSet):
+    from bot import bot
+    from aiogram.utils.exceptions import TelegramAPIError
+
+    offset = None
+    delay = POLLING_RETRY_DELAY
+    try:
+        while True:
+            workers.restart_dead()
+
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT)
+            except (TelegramAPIError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # like executor.start_polling, network and api failures are waited out instead of stopping the bot
+                log(f"Get error when polling updates, retrying in {delay:g} seconds: type: '{type(e).__name__}', text: '{e}'", LogMode.ERROR)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, POLLING_MAX_RETRY_DELAY)
+                continue
+
+            delay = POLLING_RETRY_DELAY
+            for update in updates:
+                workers.put(update)
+                offset = update.update_id + 1
+    finally:
+        session = await bot.get_session()
+        await session.close()
+
+
+def main():
+    workers = WorkerSet()
+
+    # the first worker creates and migrates the database, the rest only connect to it
+    workers.start(0)
+    workers.ready[0].wait()
+    for index in range(1, WORKERS):
+        workers.start(index)
+    log(f"Started {WORKERS} workers", LogMode.OK)
+
+    try:
+        asyncio.run(poll(workers))
+    except KeyboardInterrupt:
+        pass
+    except RuntimeError as e:
+        log(f"Stopping workers: {e}", LogMode.ERROR)
+    finally:
+        workers.stop()
+
+        log("All workers stopped", LogMode.OK)
+
+
+if __name__ == "__main__":
+    main()